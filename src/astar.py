@@ -1,31 +1,45 @@
 import heapq
 
 class PriorityQueue(object):
+    """
+    Min-heap of (priority, value) pairs with an index of the current priority
+    of each queued value, so membership is O(1). Lowering a priority pushes a
+    new entry in O(log n), and entries that no longer match the index are
+    dropped when they reach the top. Equal priorities are ordered by value.
+    """
     def __init__(self):
         self.queue = []
+        self.index = {}
 
     def push(self, prio, v):
+        self.index[v] = prio
         heapq.heappush(self.queue, (prio, v))
 
     def pop(self):
-        return heapq.heappop(self.queue)
+        while True:
+            prio, v = heapq.heappop(self.queue)
+            if self.index.get(v) == prio:
+                del self.index[v]
+                return prio, v
+
+    def decrease_key(self, prio, v):
+        if prio < self.index[v]:
+            self.push(prio, v)
 
     def __contains__(self, val):
-        for p, v in self.queue:
-            if v == val:
-                return True
-        return False
+        return val in self.index
 
     def __len__(self):
-        return len(self.queue)
+        return len(self.index)
 
 def astar(start, goal, g_fcn, h_fcn, find_neighbours_fcn):
     def reconstruct_path(came_from, current_node):
-        if current_node in came_from:
-            p = reconstruct_path(came_from, came_from[current_node])
-            return p + (current_node,)
-        else:
-            return (current_node,)
+        path = [current_node]
+        while current_node in came_from:
+            current_node = came_from[current_node]
+            path.append(current_node)
+        path.reverse()
+        return tuple(path)
 
     closed_list = set()
     open_list = PriorityQueue()
@@ -49,6 +63,7 @@ def astar(start, goal, g_fcn, h_fcn, find_neighbours_fcn):
                 open_list.push(f, neighbour)
                 new_is_better = True
             elif new_g < g_score[neighbour]:
+                open_list.decrease_key(new_g + h_fcn(neighbour), neighbour)
                 new_is_better = True
             else:
                 new_is_better = False
@@ -3,7 +3,16 @@ import sys
 import copy
 import re
 import array
-from collections import defaultdict
+import heapq
+import mmap
+import random
+import struct
+from collections import defaultdict, OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import astar
 
@@ -66,6 +75,9 @@ SCORE_LAMBDA_LIFT = 50
 END_STATE_WIN = 'Win'
 END_STATE_LOSE = 'Lose'
 END_STATE_ABORT = 'Abort'
+# Small integers standing for the end states in the Zobrist hash. The hash of
+# None depends on its address, so it differs between runs.
+END_STATE_CODES = {None: 0, END_STATE_WIN: 1, END_STATE_LOSE: 2, END_STATE_ABORT: 3}
 
 DEFAULT_WATER_LEVEL = -1
 DEFAULT_FLOOD_RATE = 0
@@ -79,6 +91,23 @@ RE_TRAMPOLINE = re.compile(r'Trampoline ([A-I]) targets (\d)')
 RE_BEARD_GROWTH = re.compile(r'Growth (\d+)')
 RE_RAZORS = re.compile(r'Razors (\d+)')
 
+# Index sets that are shared between a cave and its clones until written to.
+COW_SETS = ('lambdas', 'lambda_rocks', 'razors', 'beards', '_beard_frontier')
+
+# Seed for the Zobrist keys, fixed so that hashes are reproducible.
+ZOBRIST_SEED = 0x1cf9
+ZOBRIST_MASK = (1 << 64) - 1
+
+# Simulation backends. The NumPy backend computes rock movement and beard
+# growth with whole-grid array operations, which pays off for very large
+# maps. The pure Python backend is the reference implementation.
+BACKEND_PYTHON = 'python'
+BACKEND_NUMPY = 'numpy'
+
+# Width of the wall border around the grid. Every square the simulation and
+# the move cost functions look at is within this distance of the map.
+GRID_BORDER = 3
+
 def is_trampoline(content):
     return content in CAVE_TRAMPOLINE_CHARS
 
@@ -97,11 +126,365 @@ def surrounding_squares(x, y):
 def neighbour_squares(x, y):
     return [(x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)]
 
+def path_move(pos, square):
+    """
+    The move that takes the robot at pos onto square, the next square of a
+    path. A square repeated in a path, i.e. square == pos, is a wait.
+    """
+    x, y = square
+    rpx, rpy = pos
+    if x > rpx:
+        return MOVE_RIGHT
+    elif x < rpx:
+        return MOVE_LEFT
+    elif y > rpy:
+        return MOVE_UP
+    elif y < rpy:
+        return MOVE_DOWN
+    return MOVE_WAIT
+
+# Offsets from a changed square to the rocks whose next update depends on it,
+# i.e. the rock itself and the rocks that read the square in update_rock.
+ROCK_WATCH_OFFSETS = ((0, 0), (-1, 0), (1, 0), (0, 1), (-1, 1), (1, 1))
+
+def reading_order(pos):
+    x, y = pos
+    return (y, x)
+
+# Moves tried by the path search, in the order neighbours are expanded.
+PATH_MOVES = (MOVE_UP, MOVE_DOWN, MOVE_RIGHT, MOVE_LEFT)
+# Default path search cost of pushing a rock, see Cave.rock_push_cost.
+ROCK_PUSH_COST = 5
+# Edge cost table entries that aren't move costs: not computed yet, never
+# possible, and only possible into the goal of a search (i.e. robot_move_cost
+# returns a cost only if the target is the content of the square).
+EDGE_UNKNOWN = -3
+EDGE_TARGET_ONLY = -2
+EDGE_BLOCKED = -1
+# Offsets from a changed square to the squares whose outgoing move costs read
+# it in _robot_move_cost: the neighbours moving into it, the squares below a
+# possibly falling rock and the squares pushing a rock next to it.
+EDGE_WATCH_OFFSETS = ((0, -1), (0, 1), (-1, 0), (1, 0), (1, -1), (-1, -1),
+                      (2, 0), (-2, 0), (3, 0), (-3, 0))
+# Length of the grid chunks compared when looking for changed squares.
+GRID_DIFF_CHUNK = 64
+INFINITY = float('inf')
+# Side of the square clusters of the hierarchical path search, the length
+# from which an opening between two clusters gets a transition at both ends
+# instead of one in the middle, and the Manhattan distance from which the
+# solver searches hierarchically.
+CLUSTER_SIZE = 16
+CLUSTER_ENTRANCE_SPLIT = 6
+HIERARCHICAL_PATH_DISTANCE = 64
+# Default bounds of the simulating path search: the number of moves of the
+# longest path searched for and the number of cave states expanded.
+SAFE_PATH_HORIZON = 40
+SAFE_PATH_STATES = 200
+
+# Compiled map format. A compiled map is a header followed by the trampoline
+# table, the trampoline and target positions, the index sets, the additional
+# costs and finally the bordered grid, so a cave can be set up without parsing
+# or analyzing the map. Positions are stored as grid indices.
+COMPILED_SUFFIX = '.cmap'
+COMPILED_MAGIC = 'CAVC'
+COMPILED_VERSION = 1
+# Magic, version, width, height, water resistance, water level, flood rate,
+# beard growth rate, beard growth, razors carried, robot index, lift index,
+# lift open, lambda count, lambda rock count, number of trampolines, number of
+# trampoline and target positions and the lengths of COMPILED_INDEX_SETS and
+# the additional cost table.
+COMPILED_HEADER = struct.Struct('<4sHIIiiiiiiIIBIIBB7I')
+COMPILED_TRAMPOLINE = struct.Struct('<cc')
+COMPILED_POSITION = struct.Struct('<cI')
+COMPILED_INDEX_SETS = ('lambdas', 'lambda_rocks', 'razors', 'beards', '_beard_frontier', '_dirty')
+
+# Translation table that reduces a grid to what the settled-rock analysis
+# sees: rocks, solid squares and empty space for everything else.
+ROCK_LAYOUT_TABLE = ''.join([chr(c) if chr(c) == CAVE_ROCK else
+                             CAVE_WALL if chr(c) in (CAVE_WALL, CAVE_CLOSED_LIFT, CAVE_OPEN_LIFT) else
+                             CAVE_EMPTY for c in range(256)])
+
+# Number of settled-rock analyses kept per map.
+SETTLED_ROCKS_CACHE_SIZE = 16
+
+# Translation table that reduces a grid to what the connectivity of the squares
+# the robot can enter depends on. Squares the robot can stand on or push its
+# way into are all the same, and a closed lift is a wall until it opens.
+REGION_LAYOUT_TABLE = ''.join([CAVE_EMPTY if chr(c) in CAVE_OCCUPIABLE_CHARS or chr(c) == CAVE_ROBOT or chr(c) in CAVE_ANY_ROCK else
+                               CAVE_WALL if chr(c) == CAVE_CLOSED_LIFT else
+                               chr(c) for c in range(256)])
+
+# Number of region analyses kept per map.
+REGIONS_CACHE_SIZE = 16
+
+# Translation table that reduces a grid to the stable configuration the
+# distance matrices are keyed on: rocks, beards, walls, lifts and trampolines.
+# Squares the robot can stand on, and the robot itself, are all empty space.
+COST_LAYOUT_TABLE = ''.join([CAVE_EMPTY if chr(c) in (CAVE_DIRT, CAVE_LAMBDA, CAVE_RAZOR, CAVE_ROBOT) else chr(c)
+                             for c in range(256)])
+
+# Number of distance matrices kept per map.
+DISTANCE_MATRIX_CACHE_SIZE = 256
+
+# Number of find_path results kept per map.
+PATH_CACHE_SIZE = 1024
+
+def changed_squares(old, new):
+    """ Grid indices where two grid strings of the same length differ. """
+    if old == new:
+        return []
+    changed = []
+    for k in xrange(0, len(new), GRID_DIFF_CHUNK):
+        if old[k:k + GRID_DIFF_CHUNK] != new[k:k + GRID_DIFF_CHUNK]:
+            for i in xrange(k, min(k + GRID_DIFF_CHUNK, len(new))):
+                if old[i] != new[i]:
+                    changed.append(i)
+    return changed
+
 class RobotDestroyed(Exception):
     pass
 
-class Cave(object):
+class ZobristTable(object):
+    """
+    Random 64-bit keys for each (grid index, content) pair. The keys for a
+    content are generated on first use from a seed derived from the content,
+    so the keys don't depend on the order in which contents are looked up.
+    """
+    def __init__(self, size):
+        self._size = size
+        self._keys = {}
+
+    def keys(self, content):
+        keys = self._keys.get(content)
+        if keys is None:
+            r = random.Random(ZOBRIST_SEED * 256 + ord(content))
+            keys = [r.getrandbits(64) for i in xrange(self._size)]
+            self._keys[content] = keys
+        return keys
+
+    def grid_hash(self, grid):
+        h = 0
+        for i, content in enumerate(grid):
+            h ^= self.keys(content)[i]
+        return h
+
+class SettledRocks(object):
+    """
+    Where the rocks of a cave come to rest if everything but rocks, walls and
+    lifts is cleared away. Rocks fall in synchronous rounds like in the cave
+    update, but only the rocks next to a square that changed in the previous
+    round are looked at again, and the grid is updated in place.
+    Rocks are identified by their starting position.
+    """
+    SOLID = -2
+    EMPTY = -1
+
+    def __init__(self, layout, stride, origin):
+        self._stride = stride
+        self._origin = origin
+        solid, empty = self.SOLID, self.EMPTY
+        cells = [empty if c == CAVE_EMPTY else solid for c in layout]
+        rocks = [i for i, c in enumerate(layout) if c == CAVE_ROCK]
+        for i in rocks:
+            cells[i] = i
+        # Rocks that have empty squares on both sides can be pushed.
+        self.movable = set(self._pos(i) for i in rocks
+                           if cells[i - 1] == empty and cells[i + 1] == empty)
+        position = dict((i, i) for i in rocks)
+        watch = [dx + dy * stride for dx, dy in ROCK_WATCH_OFFSETS]
+        active = rocks
+        while active:
+            moves = []
+            for i in sorted(active):
+                rock = cells[i]
+                if rock < 0:
+                    continue
+                below = i - stride
+                content = cells[below]
+                if content == empty:
+                    moves.append((rock, i, below))
+                elif content >= 0:
+                    if cells[i + 1] == empty and cells[below + 1] == empty:
+                        moves.append((rock, i, below + 1))
+                    elif cells[i - 1] == empty and cells[below - 1] == empty:
+                        moves.append((rock, i, below - 1))
+            active = set()
+            for rock, i, j in moves:
+                cells[i] = empty
+                # Two rocks falling into the same square merge into the last one.
+                if cells[j] >= 0:
+                    del position[cells[j]]
+                cells[j] = rock
+                position[rock] = j
+                for k in (i, j):
+                    active.update([k + d for d in watch])
+        self._cells = cells
+        self.resting = dict((self._pos(rock), self._pos(i)) for rock, i in position.iteritems())
+        self.unmovable = set(start for start, rest in self.resting.iteritems()
+                             if start == rest) - self.movable
+
+    def _pos(self, i):
+        y, x = divmod(i - self._origin, self._stride)
+        return (x, y)
+
+    def rock_at(self, x, y):
+        """ Starting position of the rock that comes to rest at (x, y), or None. """
+        rock = self._cells[self._origin + y * self._stride + x]
+        if rock < 0:
+            return None
+        return self._pos(rock)
+
+class Regions(object):
+    """
+    Connected regions of the squares the robot may be able to enter, found
+    with union-find. Rocks count as passable since they may be pushed, beards
+    only if beards_passable (e.g. if razors are carried), and trampolines
+    join the regions of their own squares and their targets. This
+    over-estimates where the robot can go, so squares in different regions
+    are never connected by a path.
+    """
+    def __init__(self, layout, stride, portals, beards_passable):
+        parent = range(len(layout))
+        def find(i):
+            root = i
+            while parent[root] != root:
+                root = parent[root]
+            while parent[i] != root:
+                parent[i], i = root, parent[i]
+            return root
+        def union(i, j):
+            a, b = find(i), find(j)
+            if a != b:
+                parent[a] = b
+        blocked = CAVE_WALL if beards_passable else CAVE_WALL + CAVE_BEARD
+        passable = [c not in blocked for c in layout]
+        # The grid border is wall, so neighbours never wrap around a row.
+        for i in xrange(len(layout) - stride):
+            if passable[i]:
+                if passable[i + 1]:
+                    union(i, i + 1)
+                if passable[i + stride]:
+                    union(i, i + stride)
+        for i, j in portals.iteritems():
+            union(i, j)
+        # Region of each grid index, or -1 for squares that can't be entered.
+        self.region = [find(i) if passable[i] else -1 for i in xrange(len(layout))]
+
+class DistanceMatrix(object):
+    """
+    Cheapest paths between points of interest in a cave, filled in row by row
+    as they are asked for by Cave.distances_from. A matrix belongs to one
+    configuration of rocks, beards, walls, lifts and trampolines and one set
+    of the counters that move costs depend on, and is shared by all caves of
+    a map with those, wherever the robot is and whatever dirt, lambdas and
+    razors are left. Whether a square is empty still matters next to rocks,
+    so before a cave uses the matrix it is synced to the grid of that cave.
+    """
     def __init__(self):
+        # (source, target) -> (cost, path), or None if the target can't be reached.
+        self.paths = {}
+        # The grid the paths were found on, and its hash.
+        self._layout = None
+        self._grid_hash = None
+
+    def sync(self, cave):
+        """
+        Bring the matrix up to date with the grid of cave. Paths that pass a
+        square whose move costs read a changed square (see
+        EDGE_WATCH_OFFSETS) are dropped, as are the targets that couldn't be
+        reached. A square that became the robot, which costs nothing to move
+        onto, or empty next to a rock, which lets the rock be pushed, may
+        also open a cheaper way elsewhere, so paths that a detour over such a
+        square might beat are dropped too. The costs that are left are the
+        ones Cave._search would find on the grid of cave.
+        """
+        if cave._grid_hash is None:
+            cave._grid_hash = cave._zobrist.grid_hash(cave._grid)
+        if cave._grid_hash == self._grid_hash:
+            return
+        layout = cave._grid.tostring()
+        if self._layout is not None and self.paths:
+            watch = [dx + dy * cave._stride for dx, dy in EDGE_WATCH_OFFSETS]
+            affected = set()
+            cheaper = []
+            for i in changed_squares(self._layout, layout):
+                affected.add(i)
+                affected.update([i + d for d in watch])
+                if layout[i] == CAVE_ROBOT or (layout[i] == CAVE_EMPTY and
+                                               (layout[i - 1] in CAVE_ANY_ROCK or
+                                                layout[i + 1] in CAVE_ANY_ROCK)):
+                    cheaper.append(cave._pos(i))
+            portals = cave._portals()
+            # A path lists a trampoline, but not the square it lands on.
+            for i, j in portals.iteritems():
+                if j in affected:
+                    affected.add(i)
+            affected = set(cave._pos(i) for i in affected)
+            entries = [cave._pos(i) for i in portals]
+            exits = [cave._pos(j) for j in portals.itervalues()]
+            def steps(a, b):
+                # fewest moves from a to b, over a trampoline or not
+                d = abs(a[0] - b[0]) + abs(a[1] - b[1])
+                if entries:
+                    d = min(d, min([abs(a[0] - x) + abs(a[1] - y) for x, y in entries]) +
+                               min([abs(x - b[0]) + abs(y - b[1]) for x, y in exits]))
+                return d
+            # Every move costs at least this, but moving onto the robot.
+            unit = min(1, cave.rock_push_cost)
+            for key, result in self.paths.items():
+                if result is None or not affected.isdisjoint(result[1]):
+                    del self.paths[key]
+                    continue
+                source, target = key
+                for square in cheaper:
+                    # A detour passes the square or the rock next to it, and
+                    # may move onto the robot once.
+                    if unit * (steps(source, square) + steps(square, target) - 3) < result[0]:
+                        del self.paths[key]
+                        break
+        self._layout = layout
+        self._grid_hash = cave._grid_hash
+
+class PathCache(object):
+    """
+    The most recently used find_path results of a map, keyed by the grid hash
+    and move cost counters of the cave and the end points of the path. Shared
+    by all caves of a map. When full, the least recently used result is
+    dropped.
+    """
+    def __init__(self, size=PATH_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._paths = OrderedDict()
+
+    def get(self, key):
+        """ Get the (cost, path) stored for key, or None. """
+        result = self._paths.pop(key, None)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._paths[key] = result
+        return result
+
+    def put(self, key, result):
+        self._paths[key] = result
+        if len(self._paths) > self.size:
+            self._paths.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._paths)
+
+class Cave(object):
+    def __init__(self, backend=BACKEND_PYTHON):
+        if backend == BACKEND_NUMPY and numpy is None:
+            raise ValueError('The %s backend requires NumPy' % backend)
+        if backend not in (BACKEND_PYTHON, BACKEND_NUMPY):
+            raise ValueError('Unknown backend: %s' % backend)
+        self._backend = backend
         # Public attributes
         self.score = 0
         self.end_state = None
@@ -112,6 +495,10 @@ class Cave(object):
         self.flood_steps = 0
         # Number of moves under water.
         self.water_steps = 0
+        # Path search cost of pushing a rock. Like razors_carried, it is part
+        # of the key of everything that keeps move costs, so solvers can weigh
+        # pushes differently on copies of the same cave.
+        self.rock_push_cost = ROCK_PUSH_COST
         # Indicates whether at least one rock moved during the last update.
         self.rock_movement = False
         self._robot_pos = None
@@ -123,6 +510,10 @@ class Cave(object):
         self.lambdas = set()
         self.lambda_rocks = set()
         self.razors = set()
+        self.beards = set()
+        # Empty squares next to at least one beard, i.e. the squares the beard
+        # can grow into.
+        self._beard_frontier = set()
         # Beard parameters.
         self.beard_growth_rate = DEFAULT_BEARD_GROWTH_RATE
         self.beard_growth = self.beard_growth_rate - 1
@@ -137,10 +528,93 @@ class Cave(object):
         self._trampoline_target_pos = {}
 
         self._additional_cost = {}
-        self._cave = None
+        # The grid is a flat character buffer with a wall border of
+        # GRID_BORDER squares on each side. Square (x, y) is found at
+        # _origin + y * _stride + x.
+        self._grid = None
+        self._width = 0
+        self._height = 0
+        self._stride = 0
+        self._origin = 0
+        # Index offsets for each move direction.
+        self._offset = {}
+        # Zobrist keys for the grid, shared by all clones, and the hash of the
+        # grid contents. The hash is computed on first use and then kept up to
+        # date by set().
+        self._zobrist = None
+        self._grid_hash = None
+        # Settled-rock analyses by rock layout, shared by all clones.
+        self._settled_rocks = {}
+        # Region analyses by region layout and razors, shared by all clones,
+        # and the analysis of this state with whether razors were carried.
+        # The latter is reset whenever the grid is written to.
+        self._regions = {}
+        self._region_analysis = None
+        # Edge cost table for the path search and the counters it depends on.
+        # Reset whenever the grid is written to.
+        self._edge_costs = None
+        # Distance matrices by the hash of the stable configuration (see
+        # COST_LAYOUT_TABLE) and the move cost counters, shared by all clones,
+        # and the matrix of this state with the counters it was looked up for.
+        # The latter is reset whenever the grid is written to. The hash is
+        # computed on first use and then kept up to date by set().
+        self._distance_matrices = {}
+        self._distance_matrix = None
+        self._layout_hash = None
+        # Recent find_path results and the abstract graph for hierarchical
+        # path search, shared by all clones.
+        self._path_cache = PathCache()
+        self._path_hierarchy = PathHierarchy()
+        # Copy-on-write bookkeeping: whether the grid is owned by this instance
+        # and the index sets still shared with other instances.
+        self._own_grid = True
+        self._shared_sets = set()
+        # Changes recorded for undo() while a do_move() is in progress.
+        self._undo_log = None
+        # Squares written since the last update. Only rocks next to these
+        # squares can move in the next update.
+        self._dirty = set()
 
     def __str__(self):
-        return '\n'.join([''.join(row) for row in reversed(self._cave)])
+        rows = []
+        for y in reversed(range(self._height)):
+            start = self._origin + y * self._stride
+            rows.append(self._grid[start:start + self._width].tostring())
+        return '\n'.join(rows)
+
+    def _state_key(self):
+        """ Everything but the grid that makes up the state of the cave. """
+        return (self.end_state, self.water_level, self.flood_steps, self.water_steps,
+                self.beard_growth, self.razors_carried, self._lift_open)
+
+    @property
+    def zobrist_hash(self):
+        """
+        64-bit hash of the cave state. Identical states have identical hashes,
+        also in other runs and processes, as the state is hashed as integers.
+        """
+        if self._grid_hash is None:
+            self._grid_hash = self._zobrist.grid_hash(self._grid)
+        state = self._state_key()
+        state = (END_STATE_CODES[state[0]],) + state[1:]
+        return (self._grid_hash ^ hash(state)) & ZOBRIST_MASK
+
+    def __hash__(self):
+        return self.zobrist_hash
+
+    def __eq__(self, other):
+        if not isinstance(other, Cave):
+            return NotImplemented
+        return (self is other or
+                (self.zobrist_hash == other.zobrist_hash and
+                 self._state_key() == other._state_key() and
+                 self._grid == other._grid))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
     def state_str(self):
         s = []
@@ -163,23 +637,91 @@ class Cave(object):
 
     @property
     def size(self):
-        return (len(self._cave[0]), len(self._cave))
+        return (self._width, self._height)
 
     def at(self, x, y):
-        try:
-            if x < 0 or y < 0:
-                raise IndexError()
-            return self._cave[y][x]
-        except IndexError:
-            return CAVE_WALL
-            
+        """ Squares within GRID_BORDER squares outside the map are walls. """
+        return self._grid[self._origin + y * self._stride + x]
+
     def set(self, x, y, content):
-        try:
-            if x < 0 or y < 0:
-                raise IndexError()
-            self._cave[y][x] = content
-        except IndexError:
-            pass
+        if not self._own_grid:
+            self._grid = self._grid[:]
+            self._own_grid = True
+        i = self._origin + y * self._stride + x
+        old = self._grid[i]
+        if self._undo_log is not None:
+            self._undo_log.append((i, old))
+        zobrist = self._zobrist
+        if self._grid_hash is not None:
+            self._grid_hash ^= zobrist.keys(old)[i] ^ zobrist.keys(content)[i]
+        if self._layout_hash is not None:
+            old_cost, cost = COST_LAYOUT_TABLE[ord(old)], COST_LAYOUT_TABLE[ord(content)]
+            if old_cost != cost:
+                self._layout_hash ^= zobrist.keys(old_cost)[i] ^ zobrist.keys(cost)[i]
+        self._grid[i] = content
+        self._edge_costs = None
+        self._distance_matrix = None
+        self._region_analysis = None
+        self._dirty.add((x, y))
+        if old != content and (old == CAVE_BEARD or content == CAVE_BEARD or
+                               (self.beards and (old == CAVE_EMPTY or content == CAVE_EMPTY))):
+            self._update_beard_index(x, y, old, content)
+
+    def _next_to_beard(self, x, y):
+        for pos in surrounding_squares(x, y):
+            if pos in self.beards:
+                return True
+        return False
+
+    def _update_beard_index(self, x, y, old, content):
+        """ Keep the beard set and the beard frontier up to date with a changed square. """
+        if old == CAVE_BEARD:
+            self._index_remove('beards', (x, y))
+            for pos in surrounding_squares(x, y):
+                if pos in self._beard_frontier and not self._next_to_beard(*pos):
+                    self._index_remove('_beard_frontier', pos)
+        elif content == CAVE_BEARD:
+            self._index_add('beards', (x, y))
+            for pos in surrounding_squares(x, y):
+                if self.at(*pos) == CAVE_EMPTY:
+                    self._index_add('_beard_frontier', pos)
+        if content == CAVE_EMPTY:
+            if self._next_to_beard(x, y):
+                self._index_add('_beard_frontier', (x, y))
+        elif (x, y) in self._beard_frontier:
+            self._index_remove('_beard_frontier', (x, y))
+
+    def find_squares(self, contents):
+        """ Get the positions of all squares with the given contents, in reading order. """
+        squares = []
+        grid = self._grid
+        for y in range(self._height):
+            start = self._origin + y * self._stride
+            for x in range(self._width):
+                if grid[start + x] in contents:
+                    squares.append((x, y))
+        return squares
+
+    def _own_set(self, name):
+        """ Get an index set for writing, copying it first if it is shared. """
+        s = getattr(self, name)
+        if name in self._shared_sets:
+            s = set(s)
+            setattr(self, name, s)
+            self._shared_sets.discard(name)
+        return s
+
+    def _index_add(self, name, pos):
+        s = self._own_set(name)
+        if pos not in s:
+            s.add(pos)
+            if self._undo_log is not None:
+                self._undo_log.append((name, pos, True))
+
+    def _index_remove(self, name, pos):
+        self._own_set(name).remove(pos)
+        if self._undo_log is not None:
+            self._undo_log.append((name, pos, False))
         
     def set_robot(self, x, y):
         self._robot_pos = (x, y)
@@ -196,14 +738,14 @@ class Cave(object):
         nx, ny = new_pos
         px, py = prev_pos
         falling = ny < py
-        self.lambda_rocks.remove(prev_pos)
+        self._index_remove('lambda_rocks', prev_pos)
         if falling and self.at(nx, ny - 1) != CAVE_EMPTY:
-            self.lambdas.add(new_pos)
+            self._index_add('lambdas', new_pos)
             self.lambda_rock_count -= 1
             self._lambda_count += 1
             self.set(nx, ny, CAVE_LAMBDA)
         else:
-            self.lambda_rocks.add(new_pos)
+            self._index_add('lambda_rocks', new_pos)
             self.set(nx, ny, CAVE_LAMBDA_ROCK)
         #self.rock_movement = True
         if self.at(nx, ny - 1) == CAVE_ROBOT:
@@ -212,7 +754,14 @@ class Cave(object):
     @property
     def completed(self):
         return self.end_state is not None
-    
+
+    @property
+    def abort_score(self):
+        """ The final score if the game was aborted now, or the score if it is over. """
+        if self.completed:
+            return self.score
+        return self.score + self._lambda_collected * SCORE_LAMBDA_ABORT
+
     @property
     def is_drowning(self):
         return self.water_steps >= self.water_resistance
@@ -238,16 +787,22 @@ class Cave(object):
 
     def analyze(self):
         self._lambda_count = 0
-        for y, row in enumerate(self._cave):
-            for x, content in enumerate(row):
+        for y in range(self._height):
+            for x in range(self._width):
+                content = self.at(x, y)
                 if content == CAVE_LAMBDA:
                     self._lambda_count += 1
                     self.lambdas.add((x, y))
                 elif content == CAVE_LAMBDA_ROCK:
                     self.lambda_rock_count += 1
                     self.lambda_rocks.add((x, y))
+                    self._dirty.add((x, y))
+                elif content == CAVE_ROCK:
+                    self._dirty.add((x, y))
                 elif content == CAVE_RAZOR:
                     self.razors.add((x, y))
+                elif content == CAVE_BEARD:
+                    self.beards.add((x, y))
                 elif content == CAVE_ROBOT:
                     self._robot_pos = (x, y)
                 elif content == CAVE_CLOSED_LIFT:
@@ -260,6 +815,10 @@ class Cave(object):
                     self._trampoline_target_pos[content] = (x, y)
                 elif content in CAVE_TRAMPOLINE_CHARS:
                     self._trampoline_pos[content] = (x, y)
+        for x, y in self.beards:
+            for pos in surrounding_squares(x, y):
+                if self.at(*pos) == CAVE_EMPTY:
+                    self._beard_frontier.add(pos)
 
     def load_file(self, f):
         cave_lines = []
@@ -297,10 +856,123 @@ class Cave(object):
                     self.razors_carried = int(m.group(1))
                     continue
         cave_width = max([len(line) for line in cave_lines])
-        self._cave = [array.array('c', line.ljust(cave_width)) for line in reversed(cave_lines)]
+        self._init_grid(cave_width, [line.ljust(cave_width) for line in reversed(cave_lines)])
         self.analyze()
         self.refresh_additional_cost()
 
+    def save_compiled(self, path):
+        """ Write the cave in the compiled map format, see load_compiled. """
+        index = lambda pos: self._origin + pos[1] * self._stride + pos[0]
+        trampolines = [(trampoline, target) for target, trampolines in sorted(self._target_trampoline.iteritems())
+                       for trampoline in trampolines]
+        positions = sorted(self._trampoline_pos.items() + self._trampoline_target_pos.items())
+        index_sets = [array.array('i', sorted([index(pos) for pos in getattr(self, name)]))
+                      for name in COMPILED_INDEX_SETS]
+        costs = sorted(self._additional_cost.iteritems())
+        with open(path, 'wb') as f:
+            f.write(COMPILED_HEADER.pack(
+                    COMPILED_MAGIC, COMPILED_VERSION, self._width, self._height,
+                    self.water_resistance, self.water_level, self.flood_rate,
+                    self.beard_growth_rate, self.beard_growth, self.razors_carried,
+                    index(self._robot_pos), index(self._lift_pos), self._lift_open,
+                    self._lambda_count, self.lambda_rock_count, len(trampolines), len(positions),
+                    *([len(a) for a in index_sets] + [len(costs)])))
+            for trampoline, target in trampolines:
+                f.write(COMPILED_TRAMPOLINE.pack(trampoline, target))
+            for content, pos in positions:
+                f.write(COMPILED_POSITION.pack(content, index(pos)))
+            for a in index_sets:
+                f.write(a.tostring())
+            f.write(array.array('i', [index(pos) for pos, cost in costs]).tostring())
+            f.write(array.array('i', [cost for pos, cost in costs]).tostring())
+            f.write(self._grid.tostring())
+
+    def load_compiled(self, path):
+        """
+        Load a map written by save_compiled. The file is memory-mapped and the
+        grid and index sets are read straight from it, so no parsing or
+        analysis is needed.
+        """
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fields = COMPILED_HEADER.unpack_from(data, 0)
+            if fields[:2] != (COMPILED_MAGIC, COMPILED_VERSION):
+                raise ValueError('Not a compiled map: %s' % path)
+            (width, height, self.water_resistance, self.water_level, self.flood_rate,
+             self.beard_growth_rate, self.beard_growth, self.razors_carried,
+             robot, lift, lift_open, self._lambda_count, self.lambda_rock_count,
+             trampoline_count, position_count) = fields[2:17]
+            set_lengths = fields[17:17 + len(COMPILED_INDEX_SETS)]
+            cost_count = fields[-1]
+            self._init_geometry(width, height)
+            offset = COMPILED_HEADER.size
+            for i in range(trampoline_count):
+                trampoline, target = COMPILED_TRAMPOLINE.unpack_from(data, offset)
+                offset += COMPILED_TRAMPOLINE.size
+                self._trampoline[trampoline] = target
+                self._target_trampoline[target].append(trampoline)
+            for i in range(position_count):
+                content, pos = COMPILED_POSITION.unpack_from(data, offset)
+                offset += COMPILED_POSITION.size
+                if is_trampoline(content):
+                    self._trampoline_pos[content] = self._pos(pos)
+                else:
+                    self._trampoline_target_pos[content] = self._pos(pos)
+            item_size = array.array('i').itemsize
+            def read_array(typecode, length):
+                a = array.array(typecode, data[offset:offset + length * item_size])
+                return a, offset + length * item_size
+            for name, length in zip(COMPILED_INDEX_SETS, set_lengths):
+                indexes, offset = read_array('i', length)
+                setattr(self, name, set([self._pos(i) for i in indexes]))
+            indexes, offset = read_array('i', cost_count)
+            costs, offset = read_array('i', cost_count)
+            self._additional_cost = dict(zip([self._pos(i) for i in indexes], costs))
+            self._set_grid(array.array('c', data[offset:offset + (height + 2 * GRID_BORDER) * self._stride]))
+        finally:
+            data.close()
+        self._robot_pos = self._pos(robot)
+        self._lift_pos = self._pos(lift)
+        self._lift_open = bool(lift_open)
+
+    def _pos(self, i):
+        """ Position of a grid index. """
+        y, x = divmod(i - self._origin, self._stride)
+        return (x, y)
+
+    def _init_geometry(self, width, height):
+        self._width = width
+        self._height = height
+        self._stride = width + 2 * GRID_BORDER
+        self._origin = GRID_BORDER * self._stride + GRID_BORDER
+        self._offset = dict((m, dx + dy * self._stride) for m, (dx, dy) in DPOS.iteritems())
+
+    def _set_grid(self, grid):
+        self._grid = grid
+        self._own_grid = True
+        self._zobrist = ZobristTable(len(grid))
+        self._grid_hash = None
+        self._settled_rocks = {}
+        self._regions = {}
+        self._region_analysis = None
+        self._edge_costs = None
+        self._distance_matrices = {}
+        self._distance_matrix = None
+        self._layout_hash = None
+        self._path_cache = PathCache()
+        self._path_hierarchy = PathHierarchy()
+
+    def _init_grid(self, width, rows):
+        """ Set up the bordered grid from a list of rows, bottom row first. """
+        self._init_geometry(width, len(rows))
+        border = CAVE_WALL * GRID_BORDER
+        grid = array.array('c', CAVE_WALL * (GRID_BORDER * self._stride))
+        for row in rows:
+            grid.fromstring(border + row + border)
+        grid.fromstring(CAVE_WALL * (GRID_BORDER * self._stride))
+        self._set_grid(grid)
+
     def is_cave_str(self, s):
         return len(s) > 0 and set(s) <= CAVE_CHARS
 
@@ -309,24 +981,27 @@ class Cave(object):
         rpx, rpy = pos
         if move in (MOVE_WAIT, MOVE_ABORT):
             return 0
-        dx, dy = DPOS[move]
-        obj = self.at(rpx+dx, rpy+dy)
+        grid = self._grid
+        up = self._stride
+        i = self._origin + rpy * up + rpx
+        d = self._offset[move]
+        obj = grid[i + d]
         # don't go down when a rock is above
         # unless to a lift or trampoline
         if move == MOVE_DOWN:
-            rock_can_fall_from_left_above = self.at(rpx-1, rpy+1) in CAVE_ANY_ROCK and self.at(rpx-1, rpy) in CAVE_ANY_ROCK and self.at(rpx, rpy+1) == CAVE_EMPTY
-            rock_can_fall_from_right_above = self.at(rpx+1, rpy+1) in CAVE_ANY_ROCK and self.at(rpx+1, rpy) in CAVE_ANY_ROCK and self.at(rpx, rpy+1) == CAVE_EMPTY
-            rock_can_fall_from_straight_above = self.at(rpx, rpy+1) in CAVE_ANY_ROCK
+            rock_can_fall_from_left_above = grid[i + up - 1] in CAVE_ANY_ROCK and grid[i - 1] in CAVE_ANY_ROCK and grid[i + up] == CAVE_EMPTY
+            rock_can_fall_from_right_above = grid[i + up + 1] in CAVE_ANY_ROCK and grid[i + 1] in CAVE_ANY_ROCK and grid[i + up] == CAVE_EMPTY
+            rock_can_fall_from_straight_above = grid[i + up] in CAVE_ANY_ROCK
             if rock_can_fall_from_straight_above or rock_can_fall_from_right_above or rock_can_fall_from_left_above:
                 if obj == CAVE_OPEN_LIFT or obj in CAVE_TRAMPOLINE_CHARS:
                     return 1
                 return -1
         # rocks can be pushed, but not to block the lift
         if move in (MOVE_RIGHT, MOVE_LEFT):
-            if obj in CAVE_ANY_ROCK and self.at(rpx+2*dx, rpy) == CAVE_EMPTY:
-                if self.at(rpx+3*dx, rpy) in (CAVE_OPEN_LIFT, CAVE_CLOSED_LIFT):
+            if obj in CAVE_ANY_ROCK and grid[i + 2 * d] == CAVE_EMPTY:
+                if grid[i + 3 * d] in (CAVE_OPEN_LIFT, CAVE_CLOSED_LIFT):
                     return 1000 # really high, but not impossible
-                return 5
+                return self.rock_push_cost
         # it's possible to go to any occupiable object
         if is_occupiable(obj):
             return 1
@@ -387,7 +1062,310 @@ class Cave(object):
             pos = self._robot_pos
         return [m for m in [MOVE_UP, MOVE_DOWN, MOVE_RIGHT, MOVE_LEFT] if self.robot_move_cost(m, '', pos) >= 0]
 
-    def find_path(self, goal, pos=None):
+    def edge_costs(self):
+        """
+        Get the table of path search move costs for this state, including the
+        additional costs. The cost of moving from grid index i in direction
+        PATH_MOVES[k] is found at 4 * i + k. Entries are computed on first use,
+        and the table is shared with clones until either one changes.
+        """
+        key = (self.water_level, self.water_steps, self.razors_carried, self.rock_push_cost)
+        if self._edge_costs is None or self._edge_costs[0] != key:
+            self._edge_costs = (key, [EDGE_UNKNOWN] * (4 * len(self._grid)))
+        return self._edge_costs[1]
+
+    def _edge_cost(self, i, k):
+        move = PATH_MOVES[k]
+        x, y = self._pos(i)
+        cost = self._robot_move_cost(move, '', (x, y))
+        if cost < 0:
+            target = self._grid[i + self._offset[move]]
+            if self._robot_move_cost(move, target, (x, y)) < 0:
+                return EDGE_BLOCKED
+            return EDGE_TARGET_ONLY
+        dx, dy = DPOS[move]
+        return cost + self.additional_cost(x + dx, y + dy)
+
+    def find_path(self, goal, pos=None, hierarchical=False):
+        """
+        A* search for the cheapest path from pos (the robot by default) to
+        goal, over grid indices with the edge cost table of this state.
+        Returns (cost, path) like astar.astar, with the path as a tuple of
+        positions. Ties are broken on positions like astar.astar does, so
+        unless a trampoline is used the result is the same as that of
+        find_path_reference. Results are kept in the path cache of the map.
+        If hierarchical is true, the path is searched for on the abstract
+        graph of the map first (see PathHierarchy), which is much faster on
+        large maps but may give a slightly more expensive path. The search
+        falls back to A* if the abstract graph has no path.
+        """
+        if pos is None:
+            pos = self._robot_pos
+        if self._grid_hash is None:
+            self._grid_hash = self._zobrist.grid_hash(self._grid)
+        key = (self._grid_hash, self.water_level, self.water_steps, self.razors_carried,
+               self.rock_push_cost, pos, goal, hierarchical)
+        result = self._path_cache.get(key)
+        if result is None:
+            result = (0, tuple())
+            if hierarchical:
+                result = self._path_hierarchy.find_path(self, pos, goal)
+            if not result[1]:
+                end = self._origin + goal[1] * self._stride + goal[0]
+                found = self._search(pos, [end], self._grid[end], goal)
+                result = found.get(end, result)
+            self._path_cache.put(key, result)
+        return result
+
+    @property
+    def path_cache(self):
+        """ The find_path cache of the map, with its hit, miss and eviction counts. """
+        return self._path_cache
+
+    def find_safe_path(self, goal, horizon=SAFE_PATH_HORIZON, max_states=SAFE_PATH_STATES):
+        """
+        A* search for a path from the robot to goal that simulates each move,
+        so falling rocks, rising water and growing beards are accounted for.
+        The nodes are cave states, i.e. positions at a tick, and states that
+        have been reached before in as few moves are skipped. The robot may
+        wait for rocks to settle, and shaves before moving onto a beard like
+        the solver does when following a path. Paths longer than horizon
+        moves aren't searched for, and at most max_states states are
+        expanded. Returns (moves, path) like find_path, where following the
+        path from this state reaches goal without the robot being destroyed.
+        """
+        gx, gy = goal
+        end = self._origin + gy * self._stride + gx
+        hops = []
+        for i, j in self._portals([end]).iteritems():
+            (tx, ty), (lx, ly) = self._pos(i), self._pos(j)
+            hops.append((tx, ty, abs(lx - gx) + abs(ly - gy)))
+        def h(pos):
+            x, y = pos
+            d = abs(x - gx) + abs(y - gy)
+            for tx, ty, td in hops:
+                d = min(d, abs(x - tx) + abs(y - ty) + td)
+            return d
+        # Entries are (f, tie, moves, cave, path), where path is a linked
+        # list (square, rest) of the squares moved onto, latest first.
+        queue = [(h(self._robot_pos), 0, 0, self, None)]
+        reached = {hash(self): 0}
+        tie = 0
+        for i in xrange(max_states):
+            if not queue:
+                break
+            f, _, g, c, path = heapq.heappop(queue)
+            if g >= horizon:
+                continue
+            x, y = c._robot_pos
+            moves = PATH_MOVES + (MOVE_WAIT,) if c.rock_movement else PATH_MOVES
+            for move in moves:
+                dx, dy = DPOS[move]
+                square = (x + dx, y + dy)
+                content = c.at(*square)
+                if content == CAVE_WALL:
+                    continue
+                next, steps = c, 1
+                if content == CAVE_BEARD and move != MOVE_WAIT:
+                    if not c.razors_carried:
+                        continue
+                    next, steps = c.move(MOVE_SHAVE), 2
+                next = next.move(move)
+                if next.end_state in (END_STATE_LOSE, END_STATE_ABORT):
+                    continue
+                if move != MOVE_WAIT and next._robot_pos == (x, y):
+                    continue
+                next_path = (square, path)
+                if next._robot_pos == goal or square == goal:
+                    squares = []
+                    while next_path is not None:
+                        squares.append(next_path[0])
+                        next_path = next_path[1]
+                    squares.append(self._robot_pos)
+                    squares.reverse()
+                    return float(g + steps), tuple(squares)
+                if next.completed:
+                    continue
+                key = hash(next)
+                if reached.get(key, horizon) <= g + steps:
+                    continue
+                reached[key] = g + steps
+                tie += 1
+                heapq.heappush(queue, (g + steps + h(next._robot_pos), tie, g + steps, next, next_path))
+        return 0, tuple()
+
+    def distances_from(self, targets, pos=None):
+        """
+        Find the cheapest paths from pos (the robot by default) to all targets
+        with one Dijkstra search per kind of target square, instead of one
+        search per target. Paths already in the distance matrix of this state
+        aren't searched for again. Returns a dict from target to (cost, path)
+        like find_path, without the targets that can't be reached.
+        """
+        if pos is None:
+            pos = self._robot_pos
+        known = self.distance_matrix().paths
+        by_content = defaultdict(list)
+        for x, y in targets:
+            if (pos, (x, y)) not in known:
+                end = self._origin + y * self._stride + x
+                by_content[self._grid[end]].append(end)
+        for content, ends in by_content.iteritems():
+            found = self._search(pos, ends, content)
+            for end in ends:
+                known[pos, self._pos(end)] = found.get(end)
+        paths = {}
+        for target in targets:
+            result = known[pos, target]
+            if result is not None:
+                paths[target] = result
+        return paths
+
+    def distance_matrix(self):
+        """
+        Get the distance matrix for the stable configuration of this state,
+        synced to its grid. Caves with the same rocks, beards, walls, lifts
+        and trampolines and the same move cost counters share the matrix, so
+        e.g. after a robot step only the paths near the squares that changed
+        are searched for again.
+        """
+        counters = (self.water_level, self.water_steps, self.razors_carried, self.rock_push_cost)
+        if self._distance_matrix is None or self._distance_matrix[0] != counters:
+            if self._layout_hash is None:
+                layout = self._grid.tostring().translate(COST_LAYOUT_TABLE)
+                self._layout_hash = self._zobrist.grid_hash(layout)
+            key = (self._layout_hash, counters)
+            matrix = self._distance_matrices.get(key)
+            if matrix is None:
+                if len(self._distance_matrices) >= DISTANCE_MATRIX_CACHE_SIZE:
+                    self._distance_matrices.clear()
+                matrix = DistanceMatrix()
+                self._distance_matrices[key] = matrix
+            self._distance_matrix = (counters, matrix)
+        matrix = self._distance_matrix[1]
+        matrix.sync(self)
+        return matrix
+
+    def _search(self, pos, ends, target, goal=None):
+        """
+        Search from pos until all grid indices in ends have been reached, with
+        target as the content of the squares that may be entered as a goal.
+        Moving onto an active trampoline that isn't an end leads on to its
+        target, so such a path lists the trampoline but not the target square
+        the robot lands on. With a goal position this is an A* search with the
+        shorter of the Manhattan distance to it and of the distance to the
+        nearest trampoline plus the distance from the nearest landing square
+        to it as heuristic, otherwise a Dijkstra search. The heuristic never
+        over-estimates, also over trampoline chains, but as moving onto the
+        robot costs nothing it isn't consistent, so a closed index is opened
+        again when it is reached more cheaply. Returns a dict from each
+        reached end index to (cost, path).
+        """
+        grid = self._grid
+        stride = self._stride
+        rows = len(grid) // stride
+        costs = self.edge_costs()
+        offsets = [self._offset[m] for m in PATH_MOVES]
+        start = self._origin + pos[1] * stride + pos[0]
+        portals = self._portals(ends)
+        hops = []
+        landing_distance = INFINITY
+        if goal is None:
+            heuristic = False
+            gx = gy = 0
+        else:
+            heuristic = True
+            gy, gx = divmod(self._origin + goal[1] * stride + goal[0], stride)
+            # (x, y) per trampoline, and the distance from the nearest
+            # landing square to the goal.
+            for i, j in portals.iteritems():
+                y, x = divmod(i, stride)
+                ty, tx = divmod(j, stride)
+                hops.append((x, y))
+                landing_distance = min(landing_distance, abs(tx - gx) + abs(ty - gy))
+        remaining = set(ends)
+        found = {}
+        g_score = [None] * len(grid)
+        parent = [-1] * len(grid)
+        # Trampoline moved onto to reach each index that was reached by a jump.
+        via = {}
+        closed = [False] * len(grid)
+        # Priority each open index was last pushed with, to skip stale entries.
+        queued = [None] * len(grid)
+        # Every move costs at least unit, but the one onto the robot.
+        unit = min(1, self.rock_push_cost)
+        free_moves = 0 if pos == self._robot_pos else 1
+        def h(x, y):
+            d = abs(x - gx) + abs(y - gy)
+            for tx, ty in hops:
+                d = min(d, abs(x - tx) + abs(y - ty) + landing_distance)
+            return max(0, d - free_moves) * unit
+        y, x = divmod(start, stride)
+        f = h(x, y) if heuristic else 0
+        g_score[start] = 0.0
+        queued[start] = f
+        queue = [(f, x * rows + y, start)]
+        heappush, heappop = heapq.heappush, heapq.heappop
+        while queue:
+            f, tie, i = heappop(queue)
+            if closed[i] or queued[i] != f:
+                continue
+            if i in remaining:
+                path = []
+                j = i
+                while j >= 0:
+                    path.append(self._pos(via.get(j, j)))
+                    j = parent[j]
+                path.reverse()
+                found[i] = (f, tuple(path))
+                remaining.discard(i)
+                if not remaining:
+                    break
+            closed[i] = True
+            g = g_score[i]
+            for k in range(4):
+                j = i + offsets[k]
+                landing = portals.get(j, j)
+                if closed[landing] and not heuristic:
+                    continue
+                cost = costs[4 * i + k]
+                if cost == EDGE_UNKNOWN:
+                    cost = costs[4 * i + k] = self._edge_cost(i, k)
+                if cost < 0:
+                    if cost == EDGE_BLOCKED or (grid[j] != target and landing == j):
+                        continue
+                    cost = 1 + self.additional_cost(*self._pos(j))
+                new_g = g + cost
+                if queued[landing] is not None and new_g >= g_score[landing]:
+                    continue
+                y, x = divmod(landing, stride)
+                f = new_g + h(x, y) if heuristic else new_g
+                queued[landing] = f
+                closed[landing] = False
+                heappush(queue, (f, x * rows + y, landing))
+                parent[landing] = i
+                g_score[landing] = new_g
+                if landing != j:
+                    via[landing] = j
+                else:
+                    via.pop(j, None)
+        return found
+
+    def _portals(self, ends=()):
+        """
+        Map the grid index of each trampoline that is still on the grid and
+        isn't one of ends to the grid index of its target.
+        """
+        portals = {}
+        for trampoline, (x, y) in self._trampoline_pos.iteritems():
+            i = self._origin + y * self._stride + x
+            if self._grid[i] == trampoline and i not in ends:
+                tx, ty = self._trampoline_target_pos[self._trampoline[trampoline]]
+                portals[i] = self._origin + ty * self._stride + tx
+        return portals
+
+    def find_path_reference(self, goal, pos=None):
+        """ Generic astar.astar version of find_path, kept as a reference. """
         def gf(c):
             def g(n1, n2):
                 dx = n2[0] - n1[0]
@@ -421,113 +1399,326 @@ class Cave(object):
         return astar.astar(pos, goal, gf(self), hf(goal), nf(self))
 
     def clone(self):
-        return copy.deepcopy(self)
+        """
+        Make a copy of the cave that shares the grid and index sets with this
+        instance. The grid and sets are copied on first write by either instance,
+        so a move only pays for the parts of the state it actually touches.
+        Trampoline tables and additional costs are never written after loading
+        and are always shared.
+        """
+        next = copy.copy(self)
+        next._own_grid = False
+        next._shared_sets = set(COW_SETS)
+        self._own_grid = False
+        self._shared_sets = set(COW_SETS)
+        next._dirty = set(self._dirty)
+        next._undo_log = None
+        return next
 
     def move(self, move):
         if self.completed:
             return self
         next = self.clone()
+        if next._move_robot(move):
+            next._update()
+        return next
+
+    def update(self):
+        next = self.clone()
+        next._update()
+        return next
+
+    def replay(self, route):
+        """
+        Play a route on a single working copy of the cave, stopping when the
+        game ends. Returns a tuple (score, end_state, death_step), where
+        death_step is the index of the move that destroyed the robot, or None.
+        """
+        cave = self.clone()
+        for step, move in enumerate(route):
+            if cave.completed:
+                break
+            if cave._move_robot(move):
+                cave._update()
+            if cave.end_state == END_STATE_LOSE:
+                return (cave.score, cave.end_state, step)
+        return (cave.score, cave.end_state, None)
+
+    def do_move(self, move):
+        """
+        Make a move in place. Returns an undo token which restores the state
+        from before the move when passed to undo(). Only the squares, index
+        set entries and counters that change are recorded, so tokens must be
+        undone in reverse order.
+        """
+        token = (self._counters(), self._dirty, [])
+        if self.completed:
+            return token
+        self._dirty = set(self._dirty)
+        self._undo_log = token[2]
+        try:
+            if self._move_robot(move):
+                self._update()
+        finally:
+            self._undo_log = None
+        return token
+
+    def undo(self, token):
+        counters, dirty, log = token
+        if log and not self._own_grid:
+            self._grid = self._grid[:]
+            self._own_grid = True
+        grid = self._grid
+        if log:
+            self._edge_costs = None
+            self._distance_matrix = None
+            self._region_analysis = None
+        for entry in reversed(log):
+            if len(entry) == 2:
+                i, content = entry
+                grid[i] = content
+            else:
+                name, pos, added = entry
+                if added:
+                    self._own_set(name).remove(pos)
+                else:
+                    self._own_set(name).add(pos)
+        (self.score, self.end_state, self.water_level, self.flood_steps, self.water_steps,
+         self.rock_movement, self._robot_pos, self._lift_open, self._lambda_count,
+         self.lambda_rock_count, self._lambda_collected, self.beard_growth,
+         self.razors_carried, self._grid_hash, self._layout_hash) = counters
+        self._dirty = dirty
+
+    def _counters(self):
+        return (self.score, self.end_state, self.water_level, self.flood_steps, self.water_steps,
+                self.rock_movement, self._robot_pos, self._lift_open, self._lambda_count,
+                self.lambda_rock_count, self._lambda_collected, self.beard_growth,
+                self.razors_carried, self._grid_hash, self._layout_hash)
+
+    def _move_robot(self, move):
+        """
+        Carry out the robot part of a move on this instance. Returns True if
+        the cave should be updated afterwards, i.e. if the game isn't over.
+        """
         if move == MOVE_ABORT:
-            next.end_state = END_STATE_ABORT
-            next.score += self._lambda_collected * SCORE_LAMBDA_ABORT
-            return next
-        next.score += SCORE_MOVE
+            self.end_state = END_STATE_ABORT
+            self.score += self._lambda_collected * SCORE_LAMBDA_ABORT
+            return False
+        self.score += SCORE_MOVE
         dx, dy = DPOS[move]
-        x, y = next._robot_pos
+        x, y = self._robot_pos
         new_x = x + dx
         new_y = y + dy
-        target_content = next.at(new_x, new_y)
+        target_content = self.at(new_x, new_y)
         if target_content == CAVE_OPEN_LIFT:
-            next.set_robot(new_x, new_y)
-            next.set(x, y, CAVE_EMPTY)
-            next.end_state = END_STATE_WIN
-            next.score += self._lambda_collected * SCORE_LAMBDA_LIFT
-            return next
-        next.rock_movement = False
+            self.set_robot(new_x, new_y)
+            self.set(x, y, CAVE_EMPTY)
+            self.end_state = END_STATE_WIN
+            self.score += self._lambda_collected * SCORE_LAMBDA_LIFT
+            return False
+        self.rock_movement = False
         if target_content in (CAVE_EMPTY, CAVE_DIRT):
-            next.set_robot(new_x, new_y)
-            next.set(x, y, CAVE_EMPTY)
+            self.set_robot(new_x, new_y)
+            self.set(x, y, CAVE_EMPTY)
         elif target_content == CAVE_LAMBDA:
-            next.set_robot(new_x, new_y)
-            next.set(x, y, CAVE_EMPTY)
-            next._lambda_collected += 1
-            next._lambda_count -= 1
-            next.lambdas.remove((new_x, new_y))
-            if next._lambda_count + next.lambda_rock_count == 0:
-                next._lift_open = True
-            next.score += SCORE_LAMBDA_COLLECT
+            self.set_robot(new_x, new_y)
+            self.set(x, y, CAVE_EMPTY)
+            self._lambda_collected += 1
+            self._lambda_count -= 1
+            self._index_remove('lambdas', (new_x, new_y))
+            if self._lambda_count + self.lambda_rock_count == 0:
+                self._lift_open = True
+            self.score += SCORE_LAMBDA_COLLECT
         elif target_content == CAVE_RAZOR:
-            next.set_robot(new_x, new_y)
-            next.set(x, y, CAVE_EMPTY)
-            next.razors_carried += 1
-            next.razors.remove((new_x, new_y))
+            self.set_robot(new_x, new_y)
+            self.set(x, y, CAVE_EMPTY)
+            self.razors_carried += 1
+            self._index_remove('razors', (new_x, new_y))
         elif target_content in CAVE_TRAMPOLINE_CHARS:
-            target = next._trampoline[target_content]
-            target_pos = next._trampoline_target_pos[target]
-            next.set_robot(*target_pos)
-            next.set(x, y, CAVE_EMPTY)
-            for trampoline, pos in next._trampoline_pos.iteritems():
-                if next._trampoline[trampoline] == target:
-                    next.set(pos[0], pos[1], CAVE_EMPTY)
+            target = self._trampoline[target_content]
+            target_pos = self._trampoline_target_pos[target]
+            self.set_robot(*target_pos)
+            self.set(x, y, CAVE_EMPTY)
+            for trampoline, pos in self._trampoline_pos.iteritems():
+                if self._trampoline[trampoline] == target:
+                    self.set(pos[0], pos[1], CAVE_EMPTY)
         elif target_content == CAVE_ROCK and dy == 0:
-            if next.at(x + 2 * dx, y) == CAVE_EMPTY:
-                next.set_robot(new_x, new_y)
-                next.set(x, y, CAVE_EMPTY)
-                next.set_rock((x + 2 * dx, y), (x + dx, y))
+            if self.at(x + 2 * dx, y) == CAVE_EMPTY:
+                self.set_robot(new_x, new_y)
+                self.set(x, y, CAVE_EMPTY)
+                self.set_rock((x + 2 * dx, y), (x + dx, y))
         elif target_content == CAVE_LAMBDA_ROCK and dy == 0:
-            if next.at(x + 2 * dx, y) == CAVE_EMPTY:
-                next.set_robot(new_x, new_y)
-                next.set(x, y, CAVE_EMPTY)
-                next.set_lambda_rock((x + 2 * dx, y), (x + dx, y))
-        if move == MOVE_SHAVE and next.razors_carried > 0:
-            next.razors_carried -= 1
+            if self.at(x + 2 * dx, y) == CAVE_EMPTY:
+                self.set_robot(new_x, new_y)
+                self.set(x, y, CAVE_EMPTY)
+                self.set_lambda_rock((x + 2 * dx, y), (x + dx, y))
+        if move == MOVE_SHAVE and self.razors_carried > 0:
+            self.razors_carried -= 1
             for x, y in surrounding_squares(new_x, new_y):
-                if next.at(x, y) == CAVE_BEARD:
-                    next.set(x, y, CAVE_EMPTY)
-        assert next.at(*next._robot_pos) == CAVE_ROBOT
-        return next.update()
+                if self.at(x, y) == CAVE_BEARD:
+                    self.set(x, y, CAVE_EMPTY)
+        assert self.at(*self._robot_pos) == CAVE_ROBOT
+        return True
 
-    def update(self):
-        next = self.clone()
+    def _update(self):
+        """
+        Update this instance in place. All rock movements are decided on the
+        state from before the update, and then carried out in reading order.
+        """
         beard_growth = False
-        if next.beard_growth == 0:
+        if self.beard_growth == 0:
             beard_growth = True
-            next.beard_growth = self.beard_growth_rate - 1
+            self.beard_growth = self.beard_growth_rate - 1
         else:
-            next.beard_growth -= 1
+            self.beard_growth -= 1
+        dirty = self._dirty
+        self._dirty = set()
         try:
-            next.update_water()
-            size_x, size_y = self.size
-            for y in range(size_y):
-                for x in range(size_x):
+            self.update_water()
+            vectorized = None
+            if self._backend == BACKEND_NUMPY:
+                vectorized = self._numpy_changes(beard_growth)
+            if vectorized is None:
+                changes = []
+                for x, y in self._active_squares(beard_growth, dirty):
                     content = self.at(x, y)
-                    if content == CAVE_CLOSED_LIFT and self._lift_open:
-                        next.set(x, y, CAVE_OPEN_LIFT)
-                    elif content == CAVE_BEARD and beard_growth:
-                        next.grow_beard(x, y)
-                    elif content in CAVE_ANY_ROCK:
-                        next.update_rock(self, x, y, content)                    
+                    if content == CAVE_BEARD:
+                        changes.append((x, y, content, None))
+                    else:
+                        new_pos = self._rock_destination(x, y)
+                        if new_pos is not None:
+                            changes.append((x, y, content, new_pos))
+            if self._lift_open and self._lift_pos is not None and self.at(*self._lift_pos) == CAVE_CLOSED_LIFT:
+                self.set(self._lift_pos[0], self._lift_pos[1], CAVE_OPEN_LIFT)
+            if vectorized is None:
+                for x, y, content, new_pos in changes:
+                    if new_pos is None:
+                        self.grow_beard(x, y)
+                    else:
+                        self._place_rock(x, y, content, new_pos)
+            else:
+                moving_rocks, beard_squares = vectorized
+                for x, y, content, new_pos in moving_rocks:
+                    self.set(x, y, CAVE_EMPTY)
+                for x, y in beard_squares:
+                    self.set(x, y, CAVE_BEARD)
+                for x, y, content, new_pos in moving_rocks:
+                    if content == CAVE_ROCK:
+                        self.set_rock(new_pos, (x, y))
+                    else:
+                        self.set_lambda_rock(new_pos, (x, y))
         except RobotDestroyed:
-            next.end_state = END_STATE_LOSE
-        return next
-    
+            self.end_state = END_STATE_LOSE
+
+    def _numpy_changes(self, beard_growth):
+        """
+        Compute the rock movement and beard growth of an update with array
+        operations on the whole grid. Returns a tuple with the moving rocks,
+        as (x, y, rock_type, new_pos) in reading order, and the squares the
+        beard grows into. Returns None if the robot gets destroyed, in which
+        case the update has to stop half-way and the Python path is used.
+
+        The result matches the reading order semantics of the Python path:
+        a square that is emptied by a rock is grown into only by beards that
+        come after the rock in reading order, and a square that several rocks
+        move into gets the last one. The rocks are placed after the beard has
+        grown, which is when set_lambda_rock sees the final contents of the
+        square below.
+        """
+        ord_empty, ord_rock, ord_lambda_rock = ord(CAVE_EMPTY), ord(CAVE_ROCK), ord(CAVE_LAMBDA_ROCK)
+        grid = numpy.frombuffer(self._grid, dtype=numpy.uint8).reshape(-1, self._stride)
+        rows, cols = grid.shape
+        def shifted(a, dx, dy):
+            # Element [r, c] is the square (dx, dy) away from square [r + 1, c + 1] of a.
+            return a[1 + dy:rows - 1 + dy, 1 + dx:cols - 1 + dx]
+        here = shifted(grid, 0, 0)
+        below = shifted(grid, 0, -1)
+        rock = (here == ord_rock) | (here == ord_lambda_rock)
+        below_rock = (below == ord_rock) | (below == ord_lambda_rock)
+        empty_right = (shifted(grid, 1, 0) == ord_empty) & (shifted(grid, 1, -1) == ord_empty)
+        empty_left = (shifted(grid, -1, 0) == ord_empty) & (shifted(grid, -1, -1) == ord_empty)
+        fall = rock & (below == ord_empty)
+        slide_right = rock & empty_right & (below_rock | (below == ord(CAVE_LAMBDA)))
+        slide_left = rock & below_rock & ~empty_right & empty_left
+        moving = fall | slide_right | slide_left
+        moving_rocks = []
+        destinations = numpy.zeros_like(moving)
+        robot_above = (self._robot_pos[0], self._robot_pos[1] + 1)
+        offset = GRID_BORDER - 1
+        for r, c in numpy.transpose(numpy.nonzero(moving)).tolist():
+            dx = 1 if slide_right[r, c] else -1 if slide_left[r, c] else 0
+            destinations[r - 1, c + dx] = True
+            x, y = c - offset, r - offset
+            new_pos = (x + dx, y - 1)
+            if new_pos == robot_above:
+                return None
+            moving_rocks.append((x, y, chr(here[r, c]), new_pos))
+        beard_squares = []
+        if beard_growth:
+            beard = (grid == ord(CAVE_BEARD)).astype(numpy.int8)
+            neighbours = sum([shifted(beard, dx, dy) for dx, dy in surrounding_squares(0, 0)])
+            later = shifted(beard, 1, 0) + shifted(beard, -1, 1) + shifted(beard, 0, 1) + shifted(beard, 1, 1)
+            grow = ((here == ord_empty) & ~destinations & (neighbours > 0)) | (moving & (later > 0))
+            beard_squares = [(c - offset, r - offset) for r, c in numpy.transpose(numpy.nonzero(grow)).tolist()]
+        return (moving_rocks, beard_squares)
+
+    def _active_squares(self, beard_growth, dirty=None):
+        """
+        Get the squares that need to be evaluated in the next update, in
+        reading order: rocks next to a square written since the last update
+        (or in dirty, if given) and, if the beard grows, the beards that can
+        grow. Rocks elsewhere are known to be stable since their surroundings
+        haven't changed. A beard can only grow if it is next to the beard
+        frontier or to a rock that may move away during the update.
+        """
+        if dirty is None:
+            dirty = self._dirty
+        active = set()
+        grid = self._grid
+        stride = self._stride
+        origin = self._origin
+        for x, y in dirty:
+            i = origin + y * stride + x
+            for dx, dy in ROCK_WATCH_OFFSETS:
+                if grid[i + dy * stride + dx] in CAVE_ANY_ROCK:
+                    active.add((x + dx, y + dy))
+        if beard_growth and self.beards:
+            growing = set()
+            for squares in (self._beard_frontier, active):
+                for x, y in squares:
+                    for pos in surrounding_squares(x, y):
+                        if pos in self.beards:
+                            growing.add(pos)
+            active.update(growing)
+        return sorted(active, key=reading_order)
+
+    def _rock_destination(self, x, y):
+        """ Get the position the rock at (x, y) moves to, or None if it stays. """
+        grid = self._grid
+        i = self._origin + y * self._stride + x
+        below = i - self._stride
+        if grid[below] == CAVE_EMPTY:
+            return (x, y - 1)
+        elif grid[below] in CAVE_ANY_ROCK and grid[i + 1] == CAVE_EMPTY and grid[below + 1] == CAVE_EMPTY:
+            return (x + 1, y - 1)
+        elif grid[below] in CAVE_ANY_ROCK and grid[i - 1] == CAVE_EMPTY and grid[below - 1] == CAVE_EMPTY:
+            return (x - 1, y - 1)
+        elif grid[below] == CAVE_LAMBDA and grid[i + 1] == CAVE_EMPTY and grid[below + 1] == CAVE_EMPTY:
+            return (x + 1, y - 1)
+        return None
+
+    def _place_rock(self, x, y, rock_type, new_pos):
+        self.set(x, y, CAVE_EMPTY)
+        if rock_type == CAVE_ROCK:
+            self.set_rock(new_pos, (x, y))
+        else:
+            self.set_lambda_rock(new_pos, (x, y))
+
     def update_rock(self, previous_cave, x, y, rock_type):
-        new_pos = None
-        if previous_cave.at(x, y - 1) == CAVE_EMPTY:
-            new_pos = (x, y - 1)
-        elif previous_cave.at(x, y - 1) in CAVE_ANY_ROCK and previous_cave.at(x + 1, y) == CAVE_EMPTY and previous_cave.at(x + 1, y - 1) == CAVE_EMPTY:
-            new_pos = (x + 1, y - 1)
-        elif previous_cave.at(x, y - 1) in CAVE_ANY_ROCK and previous_cave.at(x - 1, y) == CAVE_EMPTY and previous_cave.at(x - 1, y - 1) == CAVE_EMPTY:
-            new_pos = (x - 1, y - 1)
-        elif previous_cave.at(x, y - 1) == CAVE_LAMBDA and previous_cave.at(x + 1, y) == CAVE_EMPTY and previous_cave.at(x + 1, y - 1) == CAVE_EMPTY:
-            new_pos = (x + 1, y - 1)
+        new_pos = previous_cave._rock_destination(x, y)
         if new_pos is not None:
-            self.set(x, y, CAVE_EMPTY)
-            if rock_type == CAVE_ROCK:
-                self.set_rock(new_pos, (x, y))
-            else:
-                self.set_lambda_rock(new_pos, (x, y))
-    
+            self._place_rock(x, y, rock_type, new_pos)
+
     def update_water(self):
         robot_x, robot_y = self._robot_pos
         # The robot may have left the water during robot movement.
@@ -561,80 +1752,531 @@ class Cave(object):
             moves += 1
         return (cave, moves)
         
-    def _init_rock_simulation(self):
-        sim_cave = {}
-        size_x, size_y = self.size
-        for y in range(size_y):
-            for x in range(size_x):
-                content = self.at(x, y)
-                if content == CAVE_ROCK:
-                    sim_cave[x, y] = (x, y)
-                elif content in (CAVE_WALL, CAVE_CLOSED_LIFT, CAVE_OPEN_LIFT):
-                    sim_cave[x, y] = content
-                else:
-                    sim_cave[x, y] = CAVE_EMPTY
-        return sim_cave
-    
-    def _run_rock_simulation(self, sim_cave):
-        other_than_rock = (CAVE_EMPTY, CAVE_WALL, CAVE_CLOSED_LIFT, CAVE_OPEN_LIFT)
-        size_x, size_y = self.size
-        movement = True
-        while movement:
-            movement = False
-            next = copy.copy(sim_cave)
-            for y in range(size_y):
-                for x in range(size_x):
-                    content = sim_cave[x, y]
-                    if content not in other_than_rock:
-                        new_pos = None
-                        if sim_cave[x, y - 1] == CAVE_EMPTY:
-                            new_pos = (x, y - 1)
-                        elif sim_cave[x, y - 1] not in other_than_rock and sim_cave[x + 1, y] == CAVE_EMPTY and sim_cave[x + 1, y - 1] == CAVE_EMPTY:
-                            new_pos = (x + 1, y - 1)
-                        elif sim_cave[x, y - 1] not in other_than_rock and sim_cave[x - 1, y] == CAVE_EMPTY and sim_cave[x - 1, y - 1] == CAVE_EMPTY:
-                            new_pos = (x - 1, y - 1)
-                        if new_pos is not None:
-                            next[x, y] = CAVE_EMPTY
-                            next[new_pos] = content
-                            movement = True
-            sim_cave = next
-        return sim_cave
+    def settled_rocks(self):
+        """
+        Get the settled-rock analysis for the current rock layout. Analyses are
+        cached, so caves with the same rocks share a single instance.
+        """
+        layout = self._grid.tostring().translate(ROCK_LAYOUT_TABLE)
+        analysis = self._settled_rocks.get(layout)
+        if analysis is None:
+            if len(self._settled_rocks) >= SETTLED_ROCKS_CACHE_SIZE:
+                self._settled_rocks.clear()
+            analysis = SettledRocks(layout, self._stride, self._origin)
+            self._settled_rocks[layout] = analysis
+        return analysis
         
+    def regions(self, beards_passable=None):
+        """
+        Get the region analysis for the current layout of passable squares.
+        Moving through dirt and picking up lambdas doesn't change the layout,
+        so a cached analysis is used for most states. Beards are passable if
+        razors are carried, unless beards_passable says otherwise.
+        """
+        razors = self.razors_carried > 0 if beards_passable is None else beards_passable
+        if self._region_analysis is not None and self._region_analysis[0] == razors:
+            return self._region_analysis[1]
+        key = (self._grid.tostring().translate(REGION_LAYOUT_TABLE), razors)
+        analysis = self._regions.get(key)
+        if analysis is None:
+            if len(self._regions) >= REGIONS_CACHE_SIZE:
+                self._regions.clear()
+            analysis = Regions(key[0], self._stride, self._portals(), razors)
+            self._regions[key] = analysis
+        self._region_analysis = (razors, analysis)
+        return analysis
+
+    def reachable(self, pos, start=None):
+        """
+        Check in constant time if there may be a path from start (the robot
+        by default) to pos. If not, find_path won't find one either. A square
+        that can't be entered, like a closed lift, counts as reachable if a
+        neighbouring square is. As find_path may pass through squares with
+        the content of its goal, beards are passable on the way to a beard.
+        """
+        if start is None:
+            start = self._robot_pos
+        i = self._origin + pos[1] * self._stride + pos[0]
+        region = self.regions(self.razors_carried > 0 or self._grid[i] == CAVE_BEARD).region
+        r = region[self._origin + start[1] * self._stride + start[0]]
+        if region[i] >= 0:
+            return region[i] == r
+        return any([region[i + self._offset[m]] == r for m in PATH_MOVES])
+
+    def without_rocks(self, previous=None):
+        """
+        Get a copy of this state with all rocks removed, e.g. to find the
+        rocks in the way of paths. If previous is an earlier copy made by
+        this method, it is brought up to date from the squares that changed
+        since and returned, instead of removing the rocks from a new copy.
+        """
+        if previous is None or len(previous._rocks_source) != len(self._grid):
+            c = self.clone()
+            for x, y in c.find_squares(CAVE_ANY_ROCK):
+                c.set(x, y, CAVE_EMPTY)
+        else:
+            c = previous
+            grid = self._grid
+            for i in changed_squares(c._rocks_source, grid):
+                x, y = self._pos(i)
+                c.set(x, y, CAVE_EMPTY if grid[i] in CAVE_ANY_ROCK else grid[i])
+            c._robot_pos = self._robot_pos
+            (c.end_state, c.water_level, c.flood_steps, c.water_steps,
+             c.beard_growth, c.razors_carried, c._lift_open) = self._state_key()
+        c._rocks_source = self._grid[:]
+        return c
+
     def find_unmovable_rocks(self):
         """ Get a set of rocks (positions) that can't be moved. """
-        other_than_rock = (CAVE_EMPTY, CAVE_WALL, CAVE_CLOSED_LIFT, CAVE_OPEN_LIFT)
-        cave = self._init_rock_simulation()
-        size_x, size_y = self.size
-        # Find rocks that can be pushed.
-        movable = set()
-        for y in range(size_y):
-            for x in range(size_x):
-                if cave[x, y] not in other_than_rock and cave[x - 1, y] == CAVE_EMPTY and cave[x + 1, y] == CAVE_EMPTY:
-                    movable.add((x, y))
-        cave = self._run_rock_simulation(cave)
-        unmovable = set()
-        for y in range(size_y):
-            for x in range(size_x):
-                if cave[x, y] == (x, y):
-                    unmovable.add((x, y))
-        unmovable -= movable
-        return unmovable
+        return set(self.settled_rocks().unmovable)
     
     def find_bad_rocks(self):
-        other_than_rock = (CAVE_EMPTY, CAVE_WALL, CAVE_CLOSED_LIFT, CAVE_OPEN_LIFT)
-        cave = self._init_rock_simulation()
-        cave = self._run_rock_simulation(cave)
+        """ Get the rocks (positions) that end up next to the lift. """
+        analysis = self.settled_rocks()
         bad = set()
         lx, ly = self._lift_pos
         for x, y in [(lx - 1, ly), (lx, ly + 1), (lx + 1, ly)]:
-            try:
-                content = cave[x, y]
-                if content not in other_than_rock:
-                    bad.add(content)
-            except KeyError:
-                pass
+            rock = analysis.rock_at(x, y)
+            if rock is not None:
+                bad.add(rock)
         return bad
 
+class PathPlanner(object):
+    """
+    Incremental planner for paths from the robot to a fixed goal (D* Lite).
+    The search runs backwards from the goal and is kept between calls to
+    find_path, so after the robot has moved and a few squares have changed,
+    only the part of the search that depends on them is redone. Changed
+    squares are found by comparing the grid with the one of the previous
+    call, and only the move costs that depend on them are recomputed. A
+    change of the water or razor counters, of the rock push cost or of the
+    goal square starts a new search. Trampolines lead on to their targets
+    like in Cave.find_path.
+    """
+    def __init__(self, goal):
+        self.goal = goal
+        self._layout = None
+
+    def find_path(self, cave):
+        """ Find the cheapest path from the robot to the goal, like Cave.find_path. """
+        layout = cave._grid.tostring()
+        counters = (cave.water_level, cave.water_steps, cave.razors_carried, cave.rock_push_cost)
+        start = cave._origin + cave._robot_pos[1] * cave._stride + cave._robot_pos[0]
+        self._cave = cave
+        if (self._layout is None or len(layout) != len(self._layout) or
+            counters != self._counters or layout[self._end] != self._target):
+            self._reset(cave, layout, start)
+        else:
+            # Trampolines only disappear, and the squares next to them are
+            # among the affected ones below.
+            self._set_portals(cave)
+            if start != self._start:
+                self._km += self._h(self._start, start)
+                self._start = start
+            watch = [dx + dy * self._stride for dx, dy in EDGE_WATCH_OFFSETS]
+            affected = set()
+            for i in changed_squares(self._layout, layout):
+                affected.update([i + d for d in watch])
+            for i in affected:
+                self._costs[4 * i:4 * i + 4] = [EDGE_UNKNOWN] * 4
+            for i in affected:
+                if i != self._end and layout[i] != CAVE_WALL:
+                    self._rhs[i] = self._lookahead(i)
+                    self._update_vertex(i)
+        self._layout = layout
+        self._counters = counters
+        self._compute_shortest_path()
+        path = self._extract_path()
+        self._cave = None
+        return path
+
+    def _reset(self, cave, layout, start):
+        n = len(layout)
+        self._stride = cave._stride
+        self._offsets = [cave._offset[m] for m in PATH_MOVES]
+        self._end = cave._origin + self.goal[1] * cave._stride + self.goal[0]
+        self._target = layout[self._end]
+        self._set_portals(cave)
+        self._start = start
+        self._km = 0
+        # Move costs like Cave.edge_costs, kept up to date with the changed
+        # squares instead of being recomputed for every state.
+        self._costs = [EDGE_UNKNOWN] * (4 * n)
+        self._g = [INFINITY] * n
+        self._rhs = [INFINITY] * n
+        self._queue = []
+        # Key each queued square was last pushed with, to skip stale entries.
+        self._queued = {}
+        self._rhs[self._end] = 0
+        self._update_vertex(self._end)
+
+    def _set_portals(self, cave):
+        self._portals = cave._portals([self._end])
+        # Trampolines leading to each target index.
+        self._sources = defaultdict(list)
+        for i, j in self._portals.iteritems():
+            self._sources[j].append(i)
+
+    def _h(self, a, b):
+        """ Shorter of the Manhattan distance and the distance over a trampoline. """
+        stride = self._stride
+        ay, ax = divmod(a, stride)
+        by, bx = divmod(b, stride)
+        d = abs(ax - bx) + abs(ay - by)
+        for i, j in self._portals.iteritems():
+            iy, ix = divmod(i, stride)
+            jy, jx = divmod(j, stride)
+            d = min(d, abs(ax - ix) + abs(ay - iy) + abs(jx - bx) + abs(jy - by))
+        return d
+
+    def _successor(self, i, k):
+        """ Grid index reached by the move in direction PATH_MOVES[k] from i. """
+        j = i + self._offsets[k]
+        return self._portals.get(j, j)
+
+    def _cost(self, i, k):
+        """ Cost of the move in direction PATH_MOVES[k] from grid index i. """
+        cost = self._costs[4 * i + k]
+        if cost == EDGE_UNKNOWN:
+            cost = self._costs[4 * i + k] = self._cave._edge_cost(i, k)
+        if cost < 0:
+            j = i + self._offsets[k]
+            if cost == EDGE_BLOCKED or (self._cave._grid[j] != self._target and
+                                        j not in self._portals):
+                return INFINITY
+            cost = 1 + self._cave.additional_cost(*self._cave._pos(j))
+        return cost
+
+    def _predecessors(self, i):
+        """ (index, direction) of the moves that lead to grid index i. """
+        preds = []
+        if i not in self._portals:
+            preds.extend([(i - self._offsets[k], k) for k in range(4)])
+        for t in self._sources.get(i, []):
+            preds.extend([(t - self._offsets[k], k) for k in range(4)])
+        grid = self._cave._grid
+        return [(p, k) for p, k in preds if p != self._end and grid[p] != CAVE_WALL]
+
+    def _lookahead(self, i):
+        g = self._g
+        return min([self._cost(i, k) + g[self._successor(i, k)] for k in range(4)])
+
+    def _key(self, i):
+        m = min(self._g[i], self._rhs[i])
+        return (m + self._h(self._start, i) + self._km, m)
+
+    def _update_vertex(self, i):
+        if self._g[i] != self._rhs[i]:
+            key = self._key(i)
+            self._queued[i] = key
+            heapq.heappush(self._queue, (key, i))
+        elif i in self._queued:
+            del self._queued[i]
+
+    def _compute_shortest_path(self):
+        queue, queued = self._queue, self._queued
+        g, rhs = self._g, self._rhs
+        start = self._start
+        while queue:
+            key, i = queue[0]
+            if queued.get(i) != key:
+                heapq.heappop(queue)
+                continue
+            if not (key < self._key(start) or rhs[start] > g[start]):
+                break
+            new_key = self._key(i)
+            if key < new_key:
+                queued[i] = new_key
+                heapq.heapreplace(queue, (new_key, i))
+            elif g[i] > rhs[i]:
+                g[i] = rhs[i]
+                del queued[i]
+                heapq.heappop(queue)
+                for p, k in self._predecessors(i):
+                    cost = self._cost(p, k) + g[i]
+                    if cost < rhs[p]:
+                        rhs[p] = cost
+                        self._update_vertex(p)
+            else:
+                g_old = g[i]
+                g[i] = INFINITY
+                for p, k in self._predecessors(i):
+                    if rhs[p] == self._cost(p, k) + g_old:
+                        rhs[p] = self._lookahead(p)
+                    self._update_vertex(p)
+                if i != self._end:
+                    rhs[i] = self._lookahead(i)
+                self._update_vertex(i)
+
+    def _extract_path(self):
+        """
+        Follow the cheapest moves from the robot to the goal. Of equally cheap
+        moves the one to the lowest position is taken, which is what astar.astar
+        prefers too.
+        """
+        g = self._g
+        i = self._start
+        cave = self._cave
+        path = [cave._pos(i)]
+        total = 0
+        while i != self._end:
+            best = None
+            for k in range(4):
+                cost = self._cost(i, k)
+                j = self._successor(i, k)
+                candidate = (cost + g[j], cave._pos(j), cost, i + self._offsets[k])
+                if best is None or candidate < best:
+                    best = candidate
+            if best[0] == INFINITY or len(path) > len(g):
+                return 0, tuple()
+            total += best[2]
+            i = cave._origin + best[1][1] * self._stride + best[1][0]
+            path.append(cave._pos(best[3]))
+        return total, tuple(path)
+
+class PathHierarchy(object):
+    """
+    Abstract graph for hierarchical path search (HPA*) over clusters of
+    CLUSTER_SIZE squares on a side. The nodes are the squares on both sides
+    of each opening in the walls between two clusters, the trampolines and
+    their targets. The edges are the moves across cluster borders, the jumps
+    of the trampolines and the cheapest paths between the nodes of a cluster
+    that stay inside it. Walls never change, so neither do the nodes. When
+    squares have changed since the last search, only the paths inside the
+    clusters whose move costs depend on them are searched for again, and a
+    change of the water or razor counters or of the rock push cost redoes
+    all of them.
+    """
+    def __init__(self):
+        self._cluster = None
+
+    def _build(self, cave):
+        self._stride = stride = cave._stride
+        self._offsets = [cave._offset[m] for m in PATH_MOVES]
+        width, height = cave.size
+        columns = (width + CLUSTER_SIZE - 1) // CLUSTER_SIZE
+        # Cluster of each grid index, or -1 outside the map.
+        self._cluster = cluster = [-1] * len(cave._grid)
+        for y in xrange(height):
+            for x in xrange(width):
+                i = cave._origin + y * stride + x
+                cluster[i] = (y // CLUSTER_SIZE) * columns + x // CLUSTER_SIZE
+        grid = cave._grid
+        nodes = set()
+        # Moves across cluster borders: node -> [(node, direction)].
+        self._crossings = defaultdict(list)
+        index = lambda x, y: cave._origin + y * stride + x
+        openings = []
+        for b in xrange(CLUSTER_SIZE, width, CLUSTER_SIZE):
+            openings.append([(index(b - 1, y), index(b, y), PATH_MOVES.index(MOVE_RIGHT))
+                             for y in xrange(height)])
+        for b in xrange(CLUSTER_SIZE, height, CLUSTER_SIZE):
+            openings.append([(index(x, b - 1), index(x, b), PATH_MOVES.index(MOVE_UP))
+                             for x in xrange(width)])
+        for border in openings:
+            run = []
+            for a, b, k in border + [(None, None, None)]:
+                if (a is not None and grid[a] != CAVE_WALL and grid[b] != CAVE_WALL and
+                    (not run or (cluster[a], cluster[b]) == (cluster[run[0][0]], cluster[run[0][1]]))):
+                    run.append((a, b, k))
+                    continue
+                if run:
+                    if len(run) < CLUSTER_ENTRANCE_SPLIT:
+                        transitions = [run[len(run) // 2]]
+                    else:
+                        transitions = [run[0], run[-1]]
+                    for ta, tb, tk in transitions:
+                        nodes.update([ta, tb])
+                        self._crossings[ta].append((tb, tk))
+                        self._crossings[tb].append((ta, tk ^ 1))
+                run = []
+                if a is not None and grid[a] != CAVE_WALL and grid[b] != CAVE_WALL:
+                    run.append((a, b, k))
+        self._jumps = {}
+        for trampoline, (x, y) in cave._trampoline_pos.iteritems():
+            target = index(*cave._trampoline_target_pos[cave._trampoline[trampoline]])
+            self._jumps[index(x, y)] = target
+            nodes.update([index(x, y), target])
+        self._cluster_nodes = defaultdict(list)
+        for i in sorted(nodes):
+            self._cluster_nodes[cluster[i]].append(i)
+        # Cheapest paths inside the cluster: node -> (costs, parents).
+        self._paths = {}
+        self._layout = None
+        self._counters = None
+
+    def _update(self, cave):
+        if self._cluster is None:
+            self._build(cave)
+        layout = cave._grid.tostring()
+        counters = (cave.water_level, cave.water_steps, cave.razors_carried, cave.rock_push_cost)
+        if self._layout is None or counters != self._counters:
+            dirty = set(self._cluster_nodes)
+        else:
+            dirty = set()
+            watch = [dx + dy * self._stride for dx, dy in EDGE_WATCH_OFFSETS]
+            for i in changed_squares(self._layout, layout):
+                dirty.add(self._cluster[i])
+                dirty.update([self._cluster[i + d] for d in watch])
+        self._layout = layout
+        self._counters = counters
+        for c in dirty:
+            for i in self._cluster_nodes.get(c, []):
+                self._paths[i] = self._local_search(cave, i)
+
+    def _local_search(self, cave, start, end=None):
+        """
+        Dijkstra search from start that stays inside its cluster. Moving onto
+        an active trampoline ends a path, as the robot leaves the cluster. If
+        end is given, it may be entered even if it can't be stood on.
+        Returns dicts of the costs of and the parents on the cheapest paths.
+        """
+        costs = cave.edge_costs()
+        offsets = self._offsets
+        cluster = self._cluster
+        c = cluster[start]
+        stops = set(cave._portals())
+        dist = {start: 0}
+        parent = {start: -1}
+        done = set()
+        queue = [(0, start)]
+        while queue:
+            d, i = heapq.heappop(queue)
+            if i in done:
+                continue
+            done.add(i)
+            if (i in stops or i == end) and i != start:
+                continue
+            for k in range(4):
+                j = i + offsets[k]
+                if cluster[j] != c:
+                    continue
+                cost = costs[4 * i + k]
+                if cost == EDGE_UNKNOWN:
+                    cost = costs[4 * i + k] = cave._edge_cost(i, k)
+                if cost < 0:
+                    if cost == EDGE_BLOCKED or (j not in stops and j != end):
+                        continue
+                    cost = 1 + cave.additional_cost(*cave._pos(j))
+                new_d = d + cost
+                if j not in dist or new_d < dist[j]:
+                    dist[j] = new_d
+                    parent[j] = i
+                    heapq.heappush(queue, (new_d, j))
+        return dist, parent
+
+    def find_path(self, cave, pos, goal):
+        """
+        Find a path from pos to goal on the abstract graph and refine it to
+        squares, like Cave.find_path. The path is close to, but not always,
+        the cheapest. Returns (0, ()) if the abstract graph has no path, which
+        can happen even if there is one, e.g. when the goal can only be
+        entered from another cluster.
+        """
+        self._update(cave)
+        stride = self._stride
+        offsets = self._offsets
+        start = cave._origin + pos[1] * stride + pos[0]
+        end = cave._origin + goal[1] * stride + goal[0]
+        cluster = self._cluster
+        portals = cave._portals([end])
+        costs = cave.edge_costs()
+        gy, gx = divmod(end, stride)
+        hops = []
+        for i, j in portals.iteritems():
+            y, x = divmod(i, stride)
+            ty, tx = divmod(j, stride)
+            hops.append((x, y, abs(tx - gx) + abs(ty - gy)))
+        def h(i):
+            y, x = divmod(i, stride)
+            d = abs(x - gx) + abs(y - gy)
+            for tx, ty, td in hops:
+                d = min(d, abs(x - tx) + abs(y - ty) + td)
+            return d
+        # Paths inside the cluster from start and to end, which aren't nodes.
+        searches = {start: self._local_search(cave, start, end)}
+        end_nodes = self._cluster_nodes.get(cluster[end], [])
+        to_end = {}
+        for n in end_nodes + [start]:
+            if n == start:
+                dist, parent = searches[start]
+            elif n in portals:
+                continue
+            else:
+                dist, parent = searches[n] = self._local_search(cave, n, end)
+            if end in dist:
+                to_end[n] = dist[end]
+        g_score = {start: 0.0}
+        parent = {start: None}
+        queue = [(h(start), start)]
+        closed = set()
+        while queue:
+            f, i = heapq.heappop(queue)
+            if i in closed:
+                continue
+            if i == end:
+                break
+            closed.add(i)
+            g = g_score[i]
+            edges = []
+            if i in portals:
+                edges.append((portals[i], 0, 'jump'))
+            else:
+                dist = searches[i][0] if i in searches else self._paths[i][0]
+                for n in self._cluster_nodes.get(cluster[i], []):
+                    if n != i and n in dist:
+                        edges.append((n, dist[n], 'inside'))
+                if i in to_end:
+                    edges.append((end, to_end[i], 'inside'))
+                for j, k in self._crossings.get(i, []):
+                    cost = costs[4 * i + k]
+                    if cost == EDGE_UNKNOWN:
+                        cost = costs[4 * i + k] = cave._edge_cost(i, k)
+                    if cost < 0:
+                        if cost == EDGE_BLOCKED or (j not in portals and j != end):
+                            continue
+                        cost = 1 + cave.additional_cost(*cave._pos(j))
+                    edges.append((j, cost, 'cross'))
+            for j, cost, kind in edges:
+                new_g = g + cost
+                if j in closed or (j in g_score and new_g >= g_score[j]):
+                    continue
+                g_score[j] = new_g
+                parent[j] = (i, kind)
+                heapq.heappush(queue, (new_g + h(j), j))
+        if end not in g_score:
+            return 0, tuple()
+        # Refine the abstract path to squares.
+        squares = []
+        i = end
+        while parent[i] is not None:
+            prev, kind = parent[i]
+            if kind == 'inside':
+                step_parent = (searches[prev] if prev in searches else self._paths[prev])[1]
+                j = i
+                while j != prev:
+                    squares.append(j)
+                    j = step_parent[j]
+            elif kind == 'cross':
+                squares.append(i)
+            # A jump adds no square, so like in Cave.find_path the path lists
+            # the trampoline but not its target.
+            i = prev
+        squares.append(start)
+        squares.reverse()
+        return g_score[end], tuple([cave._pos(i) for i in squares])
+
+def score_route(cave_map, route):
+    """
+    Score a route on a map, given either as a Cave or as a map file name.
+    Returns the same tuple as Cave.replay.
+    """
+    if not isinstance(cave_map, Cave):
+        with open(cave_map) as f:
+            cave_map = Cave()
+            cave_map.load_file(f)
+    return cave_map.replay(route.strip())
+
 if __name__ == '__main__':
     cave = Cave()
     cave.load_file(sys.stdin)
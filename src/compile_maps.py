@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+Convert map files to the compiled map format, see Cave.load_compiled.
+Each map is written next to the original, or to the output directory if
+one is given, with the extension replaced by cave.COMPILED_SUFFIX.
+"""
+import cave
+import os
+import sys
+from optparse import OptionParser
+
+def compiled_path(filename, output_dir=None):
+    base = os.path.splitext(filename)[0] + cave.COMPILED_SUFFIX
+    if output_dir:
+        base = os.path.join(output_dir, os.path.basename(base))
+    return base
+
+def main(options, args):
+    for filename in args:
+        c = cave.Cave()
+        with open(filename) as f:
+            c.load_file(f)
+        path = compiled_path(filename, options.output_dir)
+        c.save_compiled(path)
+        print '%s -> %s' % (filename, path)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] MAP...")
+    parser.add_option("-o", "--output-dir", dest="output_dir",
+                      help="write compiled maps to DIR", metavar="DIR")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no map files given")
+    main(options, args)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+Shorten a route for a map by edits that are checked by replaying them, see
+RouteOptimizer. The route is read from the ROUTE file, or standard input,
+and the optimized route is printed.
+"""
+import cave
+import logging
+import sys
+import time
+from optparse import OptionParser
+
+# Default seconds spent optimizing a route.
+OPTIMIZE_TIME = 1.0
+
+def path_moves(cave_, path):
+    """
+    Moves that take the robot along path, which starts at the robot, in a
+    copy of cave_, shaving beards in the way. Returns None if the robot
+    doesn't get to the end of the path.
+    """
+    c = cave_.clone()
+    moves = []
+    for x, y in path[1:]:
+        if c.completed:
+            return None
+        rpx, rpy = c._robot_pos
+        move = cave.path_move((rpx, rpy), (x, y))
+        dx, dy = cave.DPOS[move]
+        if c.at(rpx+dx, rpy+dy) == cave.CAVE_BEARD:
+            c.do_move(cave.MOVE_SHAVE)
+            moves.append(cave.MOVE_SHAVE)
+        c.do_move(move)
+        moves.append(move)
+        expected = (x, y)
+        trampoline_id = c.trampoline_from_pos(expected)
+        if trampoline_id is not None and trampoline_id in cave.CAVE_TRAMPOLINE_CHARS:
+            expected = c.trampoline_target_pos(trampoline_id)
+        if c._robot_pos != expected:
+            return None
+    return "".join(moves)
+
+class RouteOptimizer(object):
+    """
+    Improves a route for a cave by cutting out loops, where the robot comes
+    back to a square without having collected anything, and by finding new
+    paths to the squares where lambdas and razors are collected. An edit is
+    kept if a replay of the route scores higher. The replay starts from the
+    state before the edit, and stops once it reaches a state of the old
+    route, as the rest of the route then plays out the same.
+
+    The best route so far is kept in route, so optimizing can be stopped at
+    any time.
+    """
+    def __init__(self, cave_, route):
+        self.cave = cave_
+        self.route = route.strip()
+        self.score = cave_.replay(self.route)[0]
+        # The cave before each move of the route, and after the last one.
+        self._states = [cave_]
+        self._states, self.route = self._replay(self.route, 0)
+
+    def _replay(self, route, start):
+        """
+        Play route on from the state before move start. Returns the states,
+        and the route without the moves after the game is over.
+        """
+        states = self._states[:start + 1]
+        c = states[-1]
+        for move in route[start:]:
+            if c.completed:
+                break
+            c = c.move(move)
+            states.append(c)
+        return states, route[:len(states) - 1]
+
+    def _events(self):
+        """ Indices of the moves that collect a lambda or a razor. """
+        states = self._states
+        return [k for k in xrange(len(states) - 1)
+                if states[k + 1]._lambda_collected != states[k]._lambda_collected or
+                   states[k + 1].razors_carried > states[k].razors_carried]
+
+    def edits(self, start=0):
+        """
+        Candidate edits as (i, j, moves), replacing route[i:j] with moves,
+        in order of i from start on.
+        """
+        states = self._states
+        route = self.route
+        events = self._events()
+        event = 0
+        for i in xrange(start, len(route)):
+            while event < len(events) and events[event] < i:
+                event += 1
+            end = events[event] if event < len(events) else len(route)
+            # whether move i is the first one after the start or after an event
+            if event == 0:
+                after_event = i == 0
+            else:
+                after_event = events[event - 1] == i - 1
+            if after_event:
+                # a new path to where the next thing is collected, or to the lift
+                j = None
+                if event < len(events):
+                    j = end + 1
+                elif states[-1].end_state == cave.END_STATE_WIN:
+                    j = end
+                if j is not None:
+                    f, path = states[i].find_path(states[j]._robot_pos)
+                    if path:
+                        moves = path_moves(states[i], path)
+                        if moves is not None and len(moves) < j - i:
+                            yield i, j, moves
+                elif route.endswith(cave.MOVE_ABORT):
+                    yield i, len(route) - 1, ""
+            # loops up to there, longest first
+            pos = states[i]._robot_pos
+            for j in xrange(end, i, -1):
+                if states[j]._robot_pos == pos:
+                    yield i, j, ""
+
+    def evaluate(self, i, j, moves):
+        """
+        Score the route with route[i:j] replaced by moves. Returns the score,
+        and the index of the state of the old route the new one reached, or
+        None.
+        """
+        states = self._states
+        route = self.route
+        c = states[i].clone()
+        for move in moves:
+            if c.completed:
+                return c.score, None
+            c.do_move(move)
+        for k in xrange(j, len(route)):
+            if c.completed:
+                return c.score, None
+            state = states[k]
+            if hash(c) == hash(state) and c == state:
+                return self.score + c.score - state.score, k
+            c.do_move(route[k])
+        return c.score, None
+
+    def apply(self, i, j, moves, score, k):
+        """ Replace route[i:j] with moves, given its score and the state reached as by evaluate. """
+        route = self.route
+        if k is None:
+            states, new_route = self._replay(route[:i] + moves + route[j:], i)
+        else:
+            states, new_route = self._replay(route[:i] + moves + route[j:k], i)
+            # the rest of the route plays out the same, with another score
+            diff = states[-1].score - self._states[k].score
+            for state in self._states[k + 1:]:
+                state.score += diff
+                states.append(state)
+            new_route += route[k:]
+        self._states = states
+        # set last, so the route is whole if optimizing is interrupted
+        self.route = new_route
+        self.score = score
+
+    def optimize(self, deadline=None):
+        """
+        Make the edits that improve the score, until there are no more or
+        until deadline (a time.time() value). Returns the best route.
+        """
+        improved = True
+        while improved:
+            improved = False
+            # after an edit, go on from where it was made
+            start = 0
+            while start is not None:
+                edits = self.edits(start)
+                start = None
+                for i, j, moves in edits:
+                    if deadline is not None and time.time() >= deadline:
+                        return self.route
+                    score, k = self.evaluate(i, j, moves)
+                    if score > self.score:
+                        logging.debug("route edit at %d: %r -> %r, score %d",
+                                      i, self.route[i:j], moves, score)
+                        self.apply(i, j, moves, score, k)
+                        improved = True
+                        start = i
+                        break
+        return self.route
+
+def optimize_route(cave_, route, budget=OPTIMIZE_TIME):
+    """ Optimize a route for a cave for at most budget seconds. """
+    return RouteOptimizer(cave_, route).optimize(time.time() + budget)
+
+def main(options, args):
+    logging.basicConfig(level=options.loglevel)
+    c = cave.Cave()
+    with open(args[0]) as f:
+        c.load_file(f)
+    if len(args) > 1:
+        with open(args[1]) as f:
+            route = f.read()
+    else:
+        route = sys.stdin.read()
+    optimizer = RouteOptimizer(c, route)
+    before = optimizer.score
+    print optimizer.optimize(time.time() + options.time)
+    logging.info("score: %d -> %d", before, optimizer.score)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] MAP [ROUTE]")
+    parser.add_option("-t", "--time", dest="time", type="float", default=OPTIMIZE_TIME,
+                      help="optimize for at most SECONDS", metavar="SECONDS")
+    parser.add_option("-l", "--log", dest="loglevel", type="int",
+                      help="logging level", default=1000)
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no map file given")
+    main(options, args)
@@ -1,13 +1,41 @@
 #!/usr/bin/env python
 #from __future__ import with_statement
+import time
+# Start of the run, which --time-limit counts from. Taken before importing
+# the rest, as that takes a noticeable part of a short time limit.
+START_TIME = time.time()
+
 import cave
+import heapq
 import logging
 import math
+import multiprocessing
+import optimize
+import Queue
 import signal
 import string
 import sys
 from optparse import OptionParser
 
+# Number of nearest lambdas BeamSolver walks to from each state, besides
+# the target list AStarSolver would pick.
+BEAM_BRANCHING = 3
+# Beam widths BeamSolver searches with in turn. With a deadline it goes on
+# multiplying the width by BEAM_WIDTH_FACTOR until interrupted.
+BEAM_WIDTHS = [1, 4, 16]
+BEAM_WIDTH_FACTOR = 4
+# Paths BeamSolver finds again for a target after something moved.
+BEAM_REPLANS = 3
+# Seconds between checks for finished solvers and better routes.
+POLL_INTERVAL = 0.005
+# Seconds of a --time-limit kept back for printing the route and exiting.
+TIME_LIMIT_MARGIN = 0.05
+# Largest part of a --time-limit spent optimizing the best route.
+OPTIMIZE_SHARE = 0.2
+
+# Queue for reporting better routes from a worker process, see run_portfolio.
+_progress = None
+
 class SolverInterrupted(Exception):
     pass
 
@@ -22,74 +50,145 @@ class Target(object):
 
 class Solver(object):
     def _signal_handler(self, signal, frame):
-        raise SolverInterrupted()
-
-    def __init__(self):
+        # Only the first signal may interrupt solving, a second one would
+        # interrupt the abort.
+        if not self._signalled:
+            self._signalled = True
+            raise SolverInterrupted()
+
+    def __init__(self, deadline=None, report=None):
+        """
+        deadline is a time.time() value when solving is interrupted, and
+        report is called with (score, route, end state) for each better
+        route found.
+        """
         self.interrupted = False
+        self._signalled = False
+        self._deadline = deadline
+        self._report = report
+        self.best_score = None
+        self.best_route = None
+        self.best_end_state = None
         signal.signal(signal.SIGINT, self._signal_handler)
 
+    def check_deadline(self):
+        if self._deadline is not None and time.time() >= self._deadline:
+            raise SolverInterrupted()
+
+    def record(self, cave_, moves):
+        """
+        Keep track of the best route so far: moves followed by an abort, or
+        just moves if the game is over.
+        """
+        score = cave_.abort_score
+        if self.best_score is None or score > self.best_score:
+            self.best_score = score
+            if cave_.completed:
+                self.best_route = moves
+                self.best_end_state = cave_.end_state
+            else:
+                self.best_route = moves + cave.MOVE_ABORT
+                self.best_end_state = cave.END_STATE_ABORT
+            if self._report:
+                self._report(score, self.best_route, self.best_end_state)
+
     def solve(self, cave):
         """Returns a route"""
 
-def get_lambda_comparer(cave_, rpos, lpos, from_below):
+def get_lambda_key(rpos, lpos, from_below):
+    """
+    Sort key for lambdas (or rocks) seen from the robot at rpos: the lowest
+    first if from_below, else the closest, and of equal ones those far from
+    the lift at lpos first.
+    """
     rpx, rpy = rpos
     lpx, lpy = lpos
-    def compare(p1, p2):
-        dx1 = abs(rpx - p1[0])
-        dy1 = abs(rpy - p1[1])
-        dx2 = abs(rpx - p2[0])
-        dy2 = abs(rpy - p2[1])
+    def key(p):
+        dx = abs(rpx - p[0])
+        dy = abs(rpy - p[1])
+        # take lambdas close to the lift later
+        lift_distance = abs(lpx - p[0]) + abs(lpy - p[1])
         if from_below:
-            diff = p1[1] - p2[1]
-            if diff == 0:
-                diff = dx1 - dx2
+            return (p[1], dx, -lift_distance)
+        return (dx + dy, dy, -lift_distance)
+    return key
+
+class TargetAnalysis(object):
+    """
+    The parts of find_target_list's analysis of a cave that only depend on
+    its squares: where the rocks are, which of them may be moved, and a copy
+    of the cave without rocks. They are kept between plans and updated from
+    the squares that changed since the last one, so planning doesn't scan
+    the whole cave every time.
+    """
+    def __init__(self):
+        self._grid = None
+        self.rocks = set()
+        # Whether each rock checked so far may be moved.
+        self._movable = {}
+        self._rockless = None
+
+    def update(self, cave_):
+        """ Bring the analysis up to date with cave_. """
+        if self._grid is None or len(self._grid) != len(cave_._grid):
+            self.rocks = set(cave_.find_squares(cave.CAVE_ANY_ROCK))
+            self._movable = {}
         else:
-            diff = (dx1+dy1) - (dx2+dy2)
-            if diff == 0:
-                diff = dy1 - dy2
-        if diff == 0:
-            # take lambdas close to the lift later
-            return (abs(lpx - p2[0]) + abs(lpy - p2[1])) - (abs(lpx - p1[0]) + abs(lpy - p1[1]))
-        return diff
-    return compare
+            grid = cave_._grid
+            for i in cave.changed_squares(self._grid, grid):
+                x, y = cave_._pos(i)
+                if grid[i] in cave.CAVE_ANY_ROCK:
+                    self.rocks.add((x, y))
+                else:
+                    self.rocks.discard((x, y))
+                # the rocks whose movability depends on the square
+                for pos in [(x, y), (x-1, y), (x+1, y), (x, y+1), (x-1, y+1), (x+1, y+1)]:
+                    self._movable.pop(pos, None)
+        self._grid = cave_._grid[:]
+        self._rockless = cave_.without_rocks(self._rockless)
+
+    def movable_rocks(self, cave_):
+        """ The rocks that may be moved sideways, perhaps after dropping them a square. """
+        def movable(rx, ry):
+            return (cave_.at(rx-1, ry) in (cave.CAVE_DIRT, cave.CAVE_RAZOR, cave.CAVE_EMPTY) or cave_.at(rx+1, ry) in (cave.CAVE_DIRT, cave.CAVE_RAZOR, cave.CAVE_EMPTY))
+        result = set()
+        for x, y in self.rocks:
+            possible = self._movable.get((x, y))
+            if possible is None:
+                possible = movable(x, y) or (cave_.at(x, y-1) in (cave.CAVE_DIRT, cave.CAVE_RAZOR) and movable(x, y-1))
+                self._movable[x, y] = possible
+            if possible:
+                result.add((x, y))
+        return result
+
+    def rockless(self):
+        """ A copy of the cave without rocks, which mustn't be changed. """
+        return self._rockless
 
 class AStarSolver(Solver):
-    def __init__(self, from_below):
-        Solver.__init__(self)
+    def __init__(self, from_below, candidates=10, push_cost=cave.ROCK_PUSH_COST, deadline=None, report=None):
+        Solver.__init__(self, deadline, report)
         self._from_below = from_below
+        self._candidates = candidates
+        self._push_cost = push_cost
         self._failed_targets = set()
         self._bad_rocks = None
+        self._analysis = TargetAnalysis()
+        # Best score at which a target list was planned from each cave state,
+        # by hash. Coming back to a state at no better score is a loop.
         self.visited = {}
 
-    def find_movable_rocks(self, cave_, pos=None):
-        w, h = cave_.size
-        rocks = self.find_stuff(cave_, cave.CAVE_ROCK)
-        rocks.extend(self.find_stuff(cave_, cave.CAVE_LAMBDA_ROCK))
-        movable_rocks = []
-        for x, y in rocks:
-            def movable(rx, ry):
-                return (cave_.at(rx-1, ry) in (cave.CAVE_DIRT, cave.CAVE_RAZOR, cave.CAVE_EMPTY) or cave_.at(rx+1, ry) in (cave.CAVE_DIRT, cave.CAVE_RAZOR, cave.CAVE_EMPTY))
-            possible = movable(x, y) or (cave_.at(x, y-1) in (cave.CAVE_DIRT, cave.CAVE_RAZOR) and movable(x, y-1))
-            if possible:
-                movable_rocks.append((x, y))
-        if pos is None:
-            pos = cave_._robot_pos
-        rpx, rpy = pos
-        movable_rocks.sort(get_lambda_comparer(cave_, pos, cave_._lift_pos, self._from_below))
-        return movable_rocks
+    def find_movable_rocks(self, cave_):
+        """ The set of rocks that may be moved, see TargetAnalysis.movable_rocks. """
+        return self._analysis.movable_rocks(cave_)
 
     def find_path_intersecting_rocks(self, cave_, lambdas):
-        c = cave_.clone()
-        w, h = c.size
-        # remove rocks
-        for y in range(h):
-            for x in range(w):
-                if c.at(x, y) in cave.CAVE_ANY_ROCK:
-                    c.set(x, y, cave.CAVE_EMPTY)
+        c = self._analysis.rockless()
         # find path
+        paths = c.distances_from(lambdas)
         intersecting = {}
         for lmb in lambdas:
-            f, path = c.find_path(lmb)
+            f, path = paths.get(lmb, (0, tuple()))
             # walk path to see if there is a rock in the way
             for pos in path:
                 if cave_.at(*pos) in cave.CAVE_ANY_ROCK:
@@ -104,9 +203,18 @@ class AStarSolver(Solver):
         if pos is None:
             pos = cave_._robot_pos
         rpx, rpy = pos
-        lambdas.sort(get_lambda_comparer(cave_, pos, cave_._lift_pos, self._from_below))
+        lambdas.sort(key=get_lambda_key(pos, cave_._lift_pos, self._from_below))
         return lambdas
 
+    def find_candidate_lambdas(self, cave_):
+        """
+        The first lambdas of find_lambdas that may be reached, as many as
+        there are candidates, without sorting all lambdas.
+        """
+        key = get_lambda_key(cave_._robot_pos, cave_._lift_pos, self._from_below)
+        reachable = [lmb for lmb in cave_.lambdas if cave_.reachable(lmb)]
+        return heapq.nsmallest(self._candidates, reachable, key=key)
+
     def find_lambda_rocks(self, cave_, pos=None):
         w, h = cave_.size
         lambdas = []
@@ -117,30 +225,28 @@ class AStarSolver(Solver):
         if pos is None:
             pos = cave_._robot_pos
         rpx, rpy = pos
-        lambdas.sort(get_lambda_comparer(cave_, pos, cave_._lift_pos, self._from_below))
+        lambdas.sort(key=get_lambda_key(pos, cave_._lift_pos, self._from_below))
         return lambdas
 
-    def move_success(self, cave_, expected):
-        trampoline_id = cave_.trampoline_from_pos(expected)
+    def landing_pos(self, cave_, pos):
+        """ Where the robot ends up by moving onto pos, which may be a trampoline. """
+        trampoline_id = cave_.trampoline_from_pos(pos)
         if trampoline_id is not None and trampoline_id in cave.CAVE_TRAMPOLINE_CHARS:
-            expected = cave_.trampoline_target_pos(trampoline_id)
-        return cave_._robot_pos == expected
+            return cave_.trampoline_target_pos(trampoline_id)
+        return pos
 
-    def follow_path(self, cave_, moves, p):
+    def move_success(self, cave_, expected):
+        return cave_._robot_pos == self.landing_pos(cave_, expected)
+
+    def follow_path(self, cave_, moves, p, safe=False):
+        """
+        Follow a path, stopping when something moves unless the path is
+        known to be safe, i.e. found by cave_.find_safe_path.
+        """
         replan = False
         for x, y in p[1:]:
             rpx, rpy = cave_._robot_pos
-            move = ""
-            if x > rpx:
-                move = cave.MOVE_RIGHT
-            elif x < rpx:
-                move = cave.MOVE_LEFT
-            elif y > rpy:
-                move = cave.MOVE_UP
-            elif y < rpy:
-                move = cave.MOVE_DOWN
-            else:
-                move = cave.MOVE_WAIT
+            move = cave.path_move((rpx, rpy), (x, y))
 
             if move:
                 # do we need to shave?
@@ -148,13 +254,13 @@ class AStarSolver(Solver):
                 if cave_.at(rpx+dx, rpy+dy) == cave.CAVE_BEARD:
                     logging.debug("shave needed at %s", (rpx+dx, rpy+dy))
                     cave_, moves, step_success, step_replan = self.move(cave_, moves, cave.MOVE_SHAVE)
-                    if step_replan:
+                    if step_replan and not safe:
                         replan = True
                         break
 
                 # execute wanted move
                 cave_, moves, step_success, step_replan = self.move(cave_, moves, move)
-                if step_replan:
+                if step_replan and not safe:
                     replan = True
                     break
 
@@ -164,6 +270,8 @@ class AStarSolver(Solver):
         return cave_, moves, success, replan
 
     def move(self, cave_, moves, move):
+        if move != cave.MOVE_ABORT:
+            self.check_deadline()
         new_cave = cave_.move(move)
         dx, dy = cave.DPOS[move]
         rpx, rpy = cave_._robot_pos
@@ -180,6 +288,7 @@ class AStarSolver(Solver):
         else:
             success = self.move_success(new_cave, (rpx+dx, rpy+dy))
         if success:
+            self.record(new_cave, moves + move)
             return new_cave, moves + move, success, new_cave.rock_movement
         else:
             return cave_, moves, success, cave_.rock_movement
@@ -212,14 +321,28 @@ class AStarSolver(Solver):
         else:
             return self.move_rock_sideways(c, x, y)
 
+    def replan(self, cave_, planner, target, replans):
+        """
+        Find a new path to target after something moved. Once a replanned
+        path has been broken too, a path found by simulating the moves is
+        preferred, as it won't be broken again. Returns (cost, path, safe).
+        """
+        if replans > 0 and cave_.reachable(target.pos):
+            f, path = cave_.find_safe_path(target.pos)
+            if path:
+                return f, path, True
+        f, path = planner.find_path(cave_)
+        return f, path, False
+
+    def find_path(self, cave_, goal, pos=None):
+        """ Find a path with cave_.find_path, hierarchically if goal is far away. """
+        if pos is None:
+            pos = cave_._robot_pos
+        far = abs(goal[0] - pos[0]) + abs(goal[1] - pos[1]) >= cave.HIERARCHICAL_PATH_DISTANCE
+        return cave_.find_path(goal, pos, hierarchical=far)
+
     def find_stuff(self, cave_, stuff):
-        w, h = cave_.size
-        stuffs = []
-        for y in range(h):
-            for x in range(w):
-                if cave_.at(x, y) in stuff:
-                    stuffs.append((x, y))
-        return stuffs
+        return cave_.find_squares(stuff)
 
     def assemble_target_list(self, cave_, curr, positions):
         tentative = []
@@ -227,7 +350,7 @@ class AStarSolver(Solver):
             if pos in self._failed_targets:
                 logging.debug("pos %s has failed before, skipping", pos)
                 return []
-            f, p = cave_.find_path(pos, curr)
+            f, p = self.find_path(cave_, pos, curr)
             if p:
                 tentative.append(Target(pos, cave_.at(*pos), p))
                 logging.debug("found path %s -> %s", curr, pos)
@@ -241,28 +364,21 @@ class AStarSolver(Solver):
 
     def find_target_list(self, cave_):
         logging.debug("find new target(s)")
-        # find some lambdas
-        lambdas = self.find_lambdas(cave_)
-        lambdas = lambdas[:10]
+        self._analysis.update(cave_)
+        # find some lambdas, leaving out the ones in other regions
+        lambdas = self.find_candidate_lambdas(cave_)
 
         # sort on path cost (lower is better)
+        paths = cave_.distances_from(lambdas)
         path_cost = {}
         for lmb in lambdas:
-            f, p = cave_.find_path(lmb)
-            if p:
-                path_cost[lmb] = int(f)
+            if lmb in paths:
+                path_cost[lmb] = int(paths[lmb][0])
             else:
                 path_cost[lmb] = 10000000
-        def lcmp(p1, p2):
-            pl1 = path_cost[p1]
-            pl2 = path_cost[p2]
-            diff = pl1 - pl2
-            # if same path length, take the one closest in y
-            if diff == 0:
-                rpx, rpy = cave_._robot_pos
-                diff = abs(rpy - p1[1]) - abs(rpy - p2[1])
-            return diff
-        lambdas.sort(lcmp)
+        # if same path length, take the one closest in y
+        rpy = cave_._robot_pos[1]
+        lambdas.sort(key=lambda lmb: (path_cost[lmb], abs(rpy - lmb[1])))
 
         # find stuff we have to clear to make an exit from those lambdas
         # throw away the ones we can't exit from
@@ -384,7 +500,7 @@ class AStarSolver(Solver):
 
         # try to get some lambda rocks
         lambda_rocks = self.find_lambda_rocks(cave_)
-        lambda_rocks = lambda_rocks[:10]
+        lambda_rocks = lambda_rocks[:self._candidates]
         lrocktoremove = {}
         lrockendpos = []
         blocked = set()
@@ -401,6 +517,9 @@ class AStarSolver(Solver):
         # assemble a list of targets with paths
         target_list = []
         for lrk in lrockendpos:
+            if not cave_.reachable(lrk):
+                logging.debug("lambda rock %s is unreachable, skipping", lrk)
+                continue
             if lrk in blocked:
                 logging.debug("lambda rock %s is blocked, skipping", lmb)
                 continue
@@ -430,9 +549,9 @@ class AStarSolver(Solver):
         targets = self.find_stuff(cave_, cave.CAVE_TARGET_CHARS)
         for t in targets:
             lambdas = self.find_lambdas(cave_, t)
+            paths = cave_.distances_from(lambdas, t)
             for l in lambdas:
-                f, path = cave_.find_path(l, t)
-                if path:
+                if l in paths:
                     logging.debug("found path from target to lambda")
                     trampolines = cave_.target_trampolines(cave_.at(*t))
                     logging.debug("trampolines: %s", trampolines)
@@ -440,7 +559,7 @@ class AStarSolver(Solver):
                         if tr in self._failed_targets:
                             logging.debug("trampoline %s has failed before, skipping", tr)
                             continue
-                        f, path = cave_.find_path(tr)
+                        f, path = self.find_path(cave_, tr)
                         if path:
                             logging.debug("found a trampoline, taking it!")
                             return [Target(tr, cave_.at(*tr), path)]
@@ -450,7 +569,10 @@ class AStarSolver(Solver):
             if cave_._lift_pos in self._failed_targets:
                 logging.debug("lift %s failed before, skipping", cave_._lift_pos)
                 return []
-            f, p = cave_.find_path(cave_._lift_pos)
+            if not cave_.reachable(cave_._lift_pos):
+                logging.debug("lift %s is unreachable", cave_._lift_pos)
+                return []
+            f, p = self.find_path(cave_, cave_._lift_pos)
             if p:
                 logging.debug("go to open lift")
                 return [Target(cave_._lift_pos, cave_.at(*cave_._lift_pos), p)]
@@ -465,12 +587,20 @@ class AStarSolver(Solver):
         moves = ""
         panic_moves = [cave.MOVE_UP, cave.MOVE_LEFT, cave.MOVE_RIGHT, cave.MOVE_DOWN, cave.MOVE_SHAVE]
         panic_count = 0
+        cave_ = cave_.clone()
+        cave_.rock_push_cost = self._push_cost
         self._bad_rocks = cave_.find_bad_rocks()
+        self.record(cave_, moves)
         try:
             while not cave_.completed:
                 logging.debug("lambdas left: %d", cave_._lambda_count)
                 if cave_.is_drowning:
                     return self.move(cave_, moves, cave.MOVE_ABORT)
+                h = hash(cave_)
+                if h in self.visited and self.visited[h] >= cave_.score:
+                    logging.debug("state planned from before, aborting")
+                    return self.move(cave_, moves, cave.MOVE_ABORT)
+                self.visited[h] = cave_.score
                 # find target list to traverse
                 target_list = self.find_target_list(cave_)
                 if not target_list:
@@ -487,13 +617,15 @@ class AStarSolver(Solver):
                     target_fail = False
                     need_panic = False
                     path = target.path
+                    safe = False
+                    planner = cave.PathPlanner(target.pos)
                     replans = 0
                     while not target_done:
                         logging.debug("trying to get from %s to target %s, %s", cave_._robot_pos, target.pos, target.obj)
                         if path:
                             logging.debug("path: %s", path)
                             # move to it
-                            new_cave, new_moves, success, replan = self.follow_path(cave_, moves, path)
+                            new_cave, new_moves, success, replan = self.follow_path(cave_, moves, path, safe)
                             if success and new_cave.end_state != cave.END_STATE_LOSE:
                                 logging.debug("successfully followed path to %s", new_cave._robot_pos)
                                 cave_ = new_cave
@@ -504,7 +636,7 @@ class AStarSolver(Solver):
                                 cave_ = new_cave
                                 moves = new_moves
                                 logging.debug("find path: %s -> %s", cave_._robot_pos, target.pos)
-                                f, path = cave_.find_path(target.pos)
+                                f, path, safe = self.replan(cave_, planner, target, replans)
                                 logging.debug("found path: %s", path)
                                 replans += 1
                             else:
@@ -512,6 +644,14 @@ class AStarSolver(Solver):
                         else:
                             need_panic = True
 
+                        if need_panic and not safe and cave_.reachable(target.pos):
+                            # try to simulate a way past what went wrong
+                            f, path = cave_.find_safe_path(target.pos)
+                            if path:
+                                logging.debug("found safe path: %s", path)
+                                safe = True
+                                need_panic = False
+
                         if need_panic:
                             # no strategy works, just move a step and see what happens
                             for m in panic_moves[panic_count:]:
@@ -525,7 +665,8 @@ class AStarSolver(Solver):
                                 if (success or replan) and not new_cave.end_state == cave.END_STATE_LOSE:
                                     cave_ = new_cave
                                     moves = new_moves
-                                    f, path = cave_.find_path(target.pos)
+                                    f, path = planner.find_path(cave_)
+                                    safe = False
                                     break
                             else:
                                 # replan on a higher level
@@ -545,32 +686,288 @@ class AStarSolver(Solver):
         return cave_, moves, True, False
 
 
+class BeamSolver(Solver):
+    """
+    Beam search over target lists. From each state in the beam, the target
+    list AStarSolver would pick and the nearest lambdas (or the open lift)
+    are walked to on a copy of the cave, and the states with the best abort
+    scores make up the next beam. States reached before at least as cheaply
+    are dropped. The search is repeated with the widths in BEAM_WIDTHS.
+    """
+    def __init__(self, from_below, branching=BEAM_BRANCHING, candidates=10, push_cost=cave.ROCK_PUSH_COST,
+                 deadline=None, report=None):
+        self._policy = AStarSolver(from_below, candidates)
+        Solver.__init__(self, deadline, report)
+        self._branching = branching
+        self._push_cost = push_cost
+
+    def widths(self):
+        for width in BEAM_WIDTHS:
+            yield width
+        if self._deadline is not None:
+            while True:
+                width *= BEAM_WIDTH_FACTOR
+                yield width
+
+    def target_lists(self, cave_):
+        """ The target lists to walk from a state. """
+        lists = []
+        target_list = self._policy.find_target_list(cave_)
+        if target_list:
+            lists.append(target_list)
+        lambdas = self._policy.find_candidate_lambdas(cave_)
+        paths = cave_.distances_from(lambdas)
+        nearest = sorted(paths, key=lambda lmb: (paths[lmb][0], lmb))
+        for lmb in nearest[:self._branching]:
+            lists.append([Target(lmb, cave.CAVE_LAMBDA, paths[lmb][1])])
+        lift = cave_._lift_pos
+        if cave_.at(*lift) == cave.CAVE_OPEN_LIFT and cave_.reachable(lift):
+            f, path = self._policy.find_path(cave_, lift)
+            if path:
+                lists.append([Target(lift, cave.CAVE_OPEN_LIFT, path)])
+        return lists
+
+    def walk(self, cave_, moves, target_list):
+        """
+        Walk a target list on a copy of cave_, finding new paths when
+        something is in the way. Returns the new (cave, moves), or None if the
+        robot can't get there alive.
+        """
+        c = cave_.clone()
+        moves = [moves]
+        for target in target_list:
+            if target.pos == c._robot_pos:
+                # wait until stable
+                c.do_move(cave.MOVE_WAIT)
+                moves.append(cave.MOVE_WAIT)
+                continue
+            path = target.path
+            replans = 0
+            end = self._policy.landing_pos(c, target.pos)
+            while c._robot_pos != end and not c.completed:
+                if not path or path[0] != c._robot_pos:
+                    if replans == BEAM_REPLANS:
+                        return None
+                    replans += 1
+                    f, path = c.find_safe_path(target.pos)
+                    if not path:
+                        return None
+                for x, y in path[1:]:
+                    rpx, rpy = c._robot_pos
+                    move = cave.path_move((rpx, rpy), (x, y))
+                    dx, dy = cave.DPOS[move]
+                    if c.at(rpx+dx, rpy+dy) == cave.CAVE_BEARD:
+                        c.do_move(cave.MOVE_SHAVE)
+                        moves.append(cave.MOVE_SHAVE)
+                    c.do_move(move)
+                    moves.append(move)
+                    if c.end_state == cave.END_STATE_LOSE:
+                        return None
+                    if c.completed or not self._policy.move_success(c, (x, y)):
+                        break
+                path = None
+            if c.completed:
+                break
+        return c, "".join(moves)
+
+    def search(self, cave_, width):
+        beam = [(cave_, "")]
+        best = {hash(cave_): cave_.abort_score}
+        while beam:
+            logging.debug("beam of %d, best score %d", len(beam), self.best_score)
+            children = {}
+            for c, moves in beam:
+                for target_list in self.target_lists(c):
+                    self.check_deadline()
+                    child = self.walk(c, moves, target_list)
+                    if child is None:
+                        continue
+                    child_cave, child_moves = child
+                    self.record(child_cave, child_moves)
+                    if child_cave.completed:
+                        continue
+                    h = hash(child_cave)
+                    score = child_cave.abort_score
+                    if h in best and best[h] >= score:
+                        continue
+                    best[h] = score
+                    children[h] = child
+            beam = sorted(children.itervalues(), key=lambda (c, moves): (-c.abort_score, moves))[:width]
+
+    def solve(self, cave_):
+        cave_ = cave_.clone()
+        cave_.rock_push_cost = self._push_cost
+        self._policy._bad_rocks = cave_.find_bad_rocks()
+        self.record(cave_, "")
+        try:
+            for width in self.widths():
+                logging.debug("beam search, width %d", width)
+                self.search(cave_, width)
+        except SolverInterrupted:
+            logging.debug("solver interrupted, abort")
+            self.interrupted = True
+        return self.best_route
+
+
+# Solvers run by main, as solver classes and their arguments. AStarSolver
+# takes whether lambdas are taken from below, how many lambdas are
+# candidates for the next target and the path search cost of pushing a
+# rock (see Cave.rock_push_cost). BeamSolver takes whether lambdas are
+# taken from below. The first three are always run, the rest if there are
+# cores to spare.
+PORTFOLIO = [(AStarSolver, (False, 10)), (AStarSolver, (True, 10)),
+             (BeamSolver, (False,)), (BeamSolver, (True,)),
+             (AStarSolver, (False, 10, 10)), (AStarSolver, (True, 10, 10)),
+             (AStarSolver, (False, 5)), (AStarSolver, (True, 5)),
+             (AStarSolver, (False, 20)), (AStarSolver, (True, 20)),
+             (AStarSolver, (False, 10, 2)), (AStarSolver, (True, 10, 2))]
+
+def solver_name(entry):
+    solver_class, params = entry
+    return "%s%s" % (solver_class.__name__, params)
+
+def init_worker(progress):
+    """
+    Set up a worker process. An interrupt is ignored while the worker is
+    between solvers, as only a running solver can stop with its best route.
+    """
+    global _progress
+    _progress = progress
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_solver(args):
+    """
+    Run a solver from the portfolio on a cave, in a worker process, until it
+    is done or deadline (a time.time() value or None). Better routes are put
+    on the progress queue as they are found. Returns the best route.
+    """
+    cave_, entry, deadline = args
+    logging.debug("starting solver %s..", solver_name(entry))
+    def report(score, route, end_state):
+        _progress.put((score, route, end_state, entry))
+    solver_class, params = entry
+    previous = signal.getsignal(signal.SIGINT)
+    try:
+        s = solver_class(*params, deadline=deadline, report=report if _progress else None)
+        s.solve(cave_)
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    paths = cave_.path_cache
+    logging.info("path cache: %d hits, %d misses, %d evictions",
+                 paths.hits, paths.misses, paths.evictions)
+    return s.best_score, s.best_route, s.best_end_state, entry
+
+def run_portfolio(cave_, portfolio, jobs, deadline=None):
+    """
+    Run each solver in portfolio on cave_, in a pool of jobs processes.
+    Returns the best (score, route, end state, portfolio entry)
+    of each solver that has found a route when all are done, or as soon as
+    deadline (a time.time() value) or a SIGINT has come. The solvers report
+    each better route they find, so none have to be waited for.
+
+    With a deadline the solvers are run in rounds of jobs, and each round is
+    given an equal share of the time left, plus whatever the rounds before
+    it didn't use. The pool is returned too, and should be terminated once
+    the route is printed, as that takes a while. The last value returned is
+    whether solving was interrupted by a SIGINT.
+    """
+    best = {}
+    def update(solution):
+        entry = solution[3]
+        if entry not in best or solution[0] > best[entry][0]:
+            best[entry] = solution
+    finished = []
+    interrupted = []
+    def on_interrupt(signum, frame):
+        interrupted.append(time.time())
+    # Installed before the pool is made, so a worker interrupted before
+    # init_worker has run doesn't raise a KeyboardInterrupt. After that,
+    # workers ignore an interrupt between solvers, and a running solver has
+    # its own handler until run_solver restores the ignoring one.
+    previous = signal.signal(signal.SIGINT, on_interrupt)
+    progress = multiprocessing.Queue()
+    pool = multiprocessing.Pool(jobs, init_worker, (progress,))
+    try:
+        rounds = (len(portfolio) + jobs - 1) // jobs
+        start = time.time()
+        for n, entry in enumerate(portfolio):
+            solver_deadline = None
+            if deadline is not None:
+                solver_deadline = start + (deadline - start) * (n // jobs + 1) / rounds
+            pool.apply_async(run_solver, [(cave_, entry, solver_deadline)], callback=finished.append)
+        pool.close()
+        while True:
+            # Checked first, so the last solver to finish is counted.
+            done = len(finished) == len(portfolio)
+            while True:
+                try:
+                    update(progress.get_nowait())
+                except Queue.Empty:
+                    break
+            for solution in finished:
+                update(solution)
+            if done or interrupted:
+                break
+            now = time.time()
+            if deadline is not None:
+                if now >= deadline:
+                    logging.debug("deadline, stopping solvers")
+                    break
+                time.sleep(min(POLL_INTERVAL, deadline - now))
+            else:
+                time.sleep(POLL_INTERVAL)
+    except:
+        pool.terminate()
+        raise
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    return best.values(), pool, bool(interrupted)
+
 def main(options, args):
     logging.basicConfig(level=options.loglevel)
     c = cave.Cave()
     if options.filename:
         logging.info("filename: %s", options.filename)
-        with open(options.filename) as f:
-            c.load_file(f)
+        if options.filename.endswith(cave.COMPILED_SUFFIX):
+            c.load_compiled(options.filename)
+        else:
+            with open(options.filename) as f:
+                c.load_file(f)
     else:
         c.load_file(sys.stdin)
-    solvers = [AStarSolver(False), AStarSolver(True)]
-    solutions = []
-    for s in solvers:
-        logging.debug("starting solver..")
-        new_c, route, success, replan = s.solve(c)
-        solutions.append((new_c.score, new_c, route))
-        if s.interrupted:
-            logging.debug("abort calculations!")
-            break
-
-    solutions.sort(reverse=True)
+    jobs = options.jobs or multiprocessing.cpu_count()
+    portfolio = PORTFOLIO[:max(3, jobs)]
+    deadline = None
+    optimize_time = options.optimize_time
+    if options.time_limit:
+        deadline = START_TIME + options.time_limit - TIME_LIMIT_MARGIN
+        optimize_time = min(optimize_time, options.time_limit * OPTIMIZE_SHARE)
+    solve_deadline = deadline - optimize_time if deadline is not None else None
+    solutions, pool, interrupted = run_portfolio(c, portfolio, jobs, solve_deadline)
+    # The best score wins, and of equal scores the first in the portfolio.
+    solutions.sort(key=lambda s: (-s[0], portfolio.index(s[3])))
+    route = cave.MOVE_ABORT
     if solutions:
-        print solutions[0][2],
-    for s in solutions:
-        score, new_c, route = s
-        logging.info("score: %d", score)
-        logging.info("end state: %s", new_c.end_state)
+        route = solutions[0][1]
+    if solutions and not interrupted and optimize_time > 0:
+        pool.terminate()
+        if deadline is None:
+            deadline = time.time() + optimize_time
+        optimizer = None
+        try:
+            optimizer = optimize.RouteOptimizer(c, route)
+            optimizer.optimize(deadline)
+        except KeyboardInterrupt:
+            logging.debug("optimizing interrupted")
+        if optimizer:
+            route = optimizer.route
+            logging.info("optimized score: %d", optimizer.score)
+    print route,
+    sys.stdout.flush()
+    pool.terminate()
+    for score, route, end_state, entry in solutions:
+        logging.info("solver %s score: %d", solver_name(entry), score)
+        logging.info("end state: %s", end_state)
 
 
 if __name__ == "__main__":
@@ -579,5 +976,12 @@ if __name__ == "__main__":
                       help="load map from FILE", metavar="FILE")
     parser.add_option("-l", "--log", dest="loglevel", type="int",
                       help="logging level", default=1000)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="number of solver processes (default: number of CPUs)")
+    parser.add_option("-t", "--time-limit", dest="time_limit", type="float",
+                      help="print the best route found within SECONDS", metavar="SECONDS")
+    parser.add_option("-O", "--optimize-time", dest="optimize_time", type="float",
+                      default=optimize.OPTIMIZE_TIME,
+                      help="spend at most SECONDS optimizing the best route", metavar="SECONDS")
     options, args = parser.parse_args()
     main(options, args)
@@ -1,7 +1,14 @@
 #!/usr/bin/python
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
+import astar
 import cave
+import optimize
+import solver
 
 ROUTE = 'DDDLLLLLLURRRRRRRRRRRRDDDDDDDLLLLLLLLLLLDDDRRRRRRRRRRRD'
 R = cave.MOVE_RIGHT
@@ -53,6 +60,22 @@ class TestCave(unittest.TestCase):
         self.assertEqual(self.water_cave.water_level, 0)
         self.assertEqual(self.water_cave.flood_rate, 8)
         
+    def test_load_compiled(self):
+        fd, path = tempfile.mkstemp(suffix=cave.COMPILED_SUFFIX)
+        os.close(fd)
+        try:
+            for original in [self.cave, self.beard_cave, self.trampoline_cave, self.water_cave]:
+                original.save_compiled(path)
+                cv = cave.Cave()
+                cv.load_compiled(path)
+                self.assertEqual(cv, original)
+                self.assertEqual(cv.state_str(), original.state_str())
+                self.assertEqual(cv.beards, original.beards)
+                self.assertEqual(cv._additional_cost, original._additional_cost)
+                self.assertEqual(cv.replay(ROUTE), original.replay(ROUTE))
+        finally:
+            os.remove(path)
+
     def test_size(self):
         self.assertEqual(self.cave.size, (15, 15))
         
@@ -65,6 +88,13 @@ class TestCave(unittest.TestCase):
         self.assertEqual(self.cave.at(2, 3), cave.CAVE_LAMBDA)
         self.assertEqual(self.cave.at(-1, -1), cave.CAVE_WALL)
         self.assertEqual(self.cave.at(*self.cave.size), cave.CAVE_WALL)
+        self.assertEqual(self.cave.at(-cave.GRID_BORDER, 14 + cave.GRID_BORDER), cave.CAVE_WALL)
+
+    def test_find_squares(self):
+        self.assertEqual(self.cave.find_squares(cave.CAVE_ROBOT), [(7, 13)])
+        lambdas = self.cave.find_squares(cave.CAVE_LAMBDA)
+        self.assertEqual(set(lambdas), self.cave.lambdas)
+        self.assertEqual(lambdas, sorted(lambdas, key=cave.reading_order))
         
     def test_move(self):
         next = [self.cave.move(cave.MOVE_WAIT)]
@@ -74,6 +104,99 @@ class TestCave(unittest.TestCase):
         self.assertEqual(next[-1]._robot_pos, (7, 12))
         self.assertEqual(next[-1].at(7, 13), cave.CAVE_EMPTY)
         
+    def test_copy_on_write(self):
+        next = self.cave.move(cave.MOVE_WAIT)
+        # The grid and index sets are shared until written to.
+        self.assertTrue(next._grid is self.cave._grid)
+        next = self.cave.move(cave.MOVE_DOWN)
+        self.assertTrue(next._grid is not self.cave._grid)
+        self.assertTrue(next.lambdas is self.cave.lambdas)
+        # Writes never leak into the previous state.
+        next.set(1, 1, cave.CAVE_EMPTY)
+        self.assertEqual(self.cave.at(1, 1), cave.CAVE_DIRT)
+        cv = apply_moves(self.cave, ROUTE[:-1])
+        self.assertEqual(len(self.cave.lambdas), 7)
+        self.assertEqual(len(cv.lambdas), 0)
+
+    def test_hash(self):
+        self.assertEqual(hash(self.cave), hash(self.cave.clone()))
+        self.assertEqual(self.cave, self.cave.clone())
+        # The same state reached by different routes.
+        cv1 = apply_moves(self.cave, [L, R, R, L])
+        cv2 = apply_moves(self.cave, [R, L, L, R])
+        self.assertEqual(cv1, cv2)
+        self.assertEqual(hash(cv1), hash(cv2))
+        self.assertNotEqual(cv1, apply_moves(self.cave, [L, R, L, R]))
+        # The incrementally maintained hash matches a full computation.
+        cv = apply_moves(self.cave, ROUTE[:20])
+        fresh = cv.clone()
+        fresh._grid_hash = None
+        self.assertEqual(cv.zobrist_hash, fresh.zobrist_hash)
+        # Counters are part of the state.
+        self.assertNotEqual(self.water_cave, self.water_cave.move(cave.MOVE_WAIT))
+        self.assertEqual(len(set([self.cave, self.cave.clone(), cv1, cv2])), 2)
+        # The hash is the same in another process.
+        script = ("import cave; c = cave.Cave(); c.load_file(open('../maps/task_desc.map')); "
+                  "print c.zobrist_hash, c.move('A').zobrist_hash")
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(output.split(), [str(self.cave.zobrist_hash),
+                                          str(self.cave.move(cave.MOVE_ABORT).zobrist_hash)])
+
+    def test_do_move_undo(self):
+        for start in [self.cave, self.beard_cave, self.horock_cave, self.trampoline_cave, self.water_cave]:
+            route = 'LLLDDRRUULDSRRRDDDDWWLLLLUURRRRRDDLLLLDDD'
+            expected = [start]
+            for move in route:
+                expected.append(expected[-1].move(move))
+            cv = start.clone()
+            tokens = []
+            for move, next in zip(route, expected[1:]):
+                tokens.append(cv.do_move(move))
+                self.assertEqual(cv, next)
+                self.assertEqual(cv.score, next.score)
+            for token, previous in reversed(zip(tokens, expected[:-1])):
+                cv.undo(token)
+                self.assertEqual(cv, previous)
+                self.assertEqual(cv.score, previous.score)
+                self.assertEqual(cv.lambdas, previous.lambdas)
+                self.assertEqual(cv.lambda_rocks, previous.lambda_rocks)
+                self.assertEqual(cv.razors, previous.razors)
+
+    def test_replay(self):
+        self.assertEqual(self.cave.replay(ROUTE), (cave.SCORE_LAMBDA_COLLECT * 7 + cave.SCORE_LAMBDA_LIFT * 7 - len(ROUTE), cave.END_STATE_WIN, None))
+        self.assertEqual(self.cave.replay(ROUTE[:10] + 'A' + ROUTE[10:]), (40, cave.END_STATE_ABORT, None))
+        self.assertEqual(self.cave.replay('LLLDD'), (-5, cave.END_STATE_LOSE, 4))
+        self.assertEqual(self.cave.replay(''), (0, None, None))
+        self.assertEqual(cave.score_route('../maps/task_desc.map', ROUTE + '\n'), self.cave.replay(ROUTE))
+        # The cave itself is left untouched.
+        self.assertEqual(str(self.cave), self.cave_str)
+
+    def test_abort_score(self):
+        c = self.cave
+        self.assertEqual(c.abort_score, 0)
+        for move in ROUTE[:10]:
+            c = c.move(move)
+            self.assertEqual(c.abort_score, c.move(cave.MOVE_ABORT).score)
+        self.assertEqual(c.abort_score, self.cave.replay(ROUTE[:10] + 'A')[0])
+        for move in ROUTE[10:]:
+            c = c.move(move)
+        self.assertEqual(c.abort_score, c.score)
+
+    def test_optimize_route(self):
+        score = self.cave.replay(ROUTE)[0]
+        # a detour, a wait and moves after the game is over
+        route = 'DLRDDW' + ROUTE[3:] + 'LL'
+        self.assertTrue(self.cave.replay(route)[0] < score)
+        optimizer = optimize.RouteOptimizer(self.cave, route)
+        optimized = optimizer.optimize()
+        self.assertEqual(self.cave.replay(optimized), (optimizer.score, cave.END_STATE_WIN, None))
+        self.assertTrue(optimizer.score >= score)
+        self.assertTrue(len(optimized) <= len(ROUTE))
+        # an aborted route keeps its abort
+        optimized = optimize.optimize_route(self.cave, ROUTE[:10] + 'LRLRW' + ROUTE[10:20] + 'A')
+        self.assertEqual(self.cave.replay(optimized)[1:], (cave.END_STATE_ABORT, None))
+        self.assertTrue(self.cave.replay(optimized)[0] >= self.cave.replay(ROUTE[:20] + 'A')[0])
+
     def test_rock_movement(self):
         move = [L, L, L, D, R, D, L, L, L, L]
         rock = [0, 0, 0, 0, 1, 0, 0, 1, 1, 1]
@@ -95,6 +218,34 @@ class TestCave(unittest.TestCase):
         stable_cave, n = cv.next_stable()
         self.assertEqual(n, 4)
         
+    def test_active_squares(self):
+        # All rocks are evaluated after loading.
+        self.assertEqual(len(self.cave._active_squares(False)), 10)
+        # Only the rocks around squares that changed are evaluated later on.
+        cv = apply_moves(self.cave, [D, D, D, D, D, D, R, R, R, R, U, U, U, R])
+        self.assertEqual(cv._active_squares(False), [(11, 9)])
+        stable_cave, n = cv.next_stable()
+        self.assertEqual(stable_cave._active_squares(False), [])
+        self.assertEqual(stable_cave.move(cave.MOVE_WAIT)._active_squares(False), [])
+
+    @unittest.skipIf(cave.numpy is None, 'NumPy is not available')
+    def test_numpy_backend(self):
+        for map_name, route in [('task_desc', ROUTE), ('beard1', 'RRDDDDRD' + 30 * 'W' + 'LLUUUL'),
+                                ('horock1', 'RRRRRUURRLDDDLLLLLL'), ('flood1', 'LLLLDDRRRRRRRLDWA')]:
+            reference = cave.Cave()
+            vectorized = cave.Cave(cave.BACKEND_NUMPY)
+            for c in (reference, vectorized):
+                with open('../maps/%s.map' % map_name) as f:
+                    c.load_file(f)
+            for move in route:
+                reference = reference.move(move)
+                vectorized = vectorized.move(move)
+                self.assertEqual(str(reference), str(vectorized))
+                self.assertEqual(reference, vectorized)
+                self.assertEqual(reference.lambdas, vectorized.lambdas)
+                self.assertEqual(reference.lambda_rocks, vectorized.lambda_rocks)
+                self.assertEqual(reference.score, vectorized.score)
+
     def test_route(self):
         self.cave = apply_moves(self.cave, ROUTE[:-1])
         self.assertEqual(self.cave._lambda_count, 0)
@@ -144,6 +295,23 @@ class TestCave(unittest.TestCase):
         self.assertEqual(cv.at(4, 1), cave.CAVE_BEARD)
         self.assertEqual(cv.at(5, 1), cave.CAVE_BEARD)
         
+    def test_beard_frontier(self):
+        def expected_frontier(c):
+            return set(pos for pos in c.find_squares(cave.CAVE_EMPTY)
+                       if any(n in c.beards for n in cave.surrounding_squares(*pos)))
+        cv = self.beard_cave
+        self.assertEqual(cv.beards, set(cv.find_squares(cave.CAVE_BEARD)))
+        self.assertTrue((4, 1) in cv._beard_frontier)
+        for move in [R, R, D, D, D, D, R, D] + cv.beard_growth_rate * [cave.MOVE_WAIT]:
+            cv = cv.move(move)
+            self.assertEqual(cv.beards, set(cv.find_squares(cave.CAVE_BEARD)))
+            self.assertEqual(cv._beard_frontier, expected_frontier(cv))
+        cv.razors_carried = 1
+        cv = cv.move(cave.MOVE_SHAVE)
+        self.assertFalse((4, 2) in cv.beards)
+        self.assertEqual(cv.beards, set(cv.find_squares(cave.CAVE_BEARD)))
+        self.assertEqual(cv._beard_frontier, expected_frontier(cv))
+
     def test_shave(self):
         move = [R, R, D, D, D, D, R, D]
         cv = apply_moves(self.beard_cave, move)
@@ -191,13 +359,324 @@ class TestCave(unittest.TestCase):
         cv = apply_moves(self.horock_cave, move)
         self.assertEqual(cv.at(4, 3), cave.CAVE_LAMBDA)
         
+    def test_find_path(self):
+        for cv in [self.cave, self.beard_cave, self.water_cave,
+                   apply_moves(self.water_cave, 'DDDDWW')]:
+            for goal in cv.find_squares([cave.CAVE_LAMBDA, cave.CAVE_ROCK, cave.CAVE_CLOSED_LIFT]):
+                self.assertEqual(cv.find_path(goal), cv.find_path_reference(goal))
+        # The edge cost table is shared until the cave changes.
+        costs = self.cave.edge_costs()
+        self.assertTrue(self.cave.clone().edge_costs() is costs)
+        self.assertTrue(self.cave.move(D).edge_costs() is not costs)
+
+    def test_solver_visited(self):
+        s = solver.AStarSolver(False)
+        s.solve(self.cave)
+        self.assertTrue(s.visited)
+        self.assertTrue(hash(self.cave) in s.visited)
+        # Coming back to a state planned from at no better score stops the solver.
+        s = solver.AStarSolver(False)
+        s.visited[hash(self.cave)] = self.cave.score
+        s.solve(self.cave)
+        self.assertEqual(s.best_route, cave.MOVE_ABORT)
+
+    def test_beam_walk_trampoline(self):
+        cv = self.trampoline_cave
+        trampoline = (3, 3)
+        f, path = cv.find_path(trampoline)
+        target = solver.Target(trampoline, cv.at(*trampoline), path)
+        result = solver.BeamSolver(False).walk(cv, '', [target])
+        self.assertTrue(result is not None)
+        c, moves = result
+        # The robot lands on the target of the trampoline.
+        self.assertEqual(c._robot_pos, (15, 1))
+        self.assertEqual(moves, optimize.path_moves(cv, path))
+
+    def test_rock_push_cost(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '#####L#\n#R*  \\#\n#######\n')
+        os.close(fd)
+        try:
+            cv = cave.Cave()
+            with open(path) as f:
+                cv.load_file(f)
+        finally:
+            os.remove(path)
+        goal = (5, 1)
+        self.assertEqual(cv.find_path(goal)[0], cave.ROCK_PUSH_COST + 3)
+        # Caves that weigh pushes differently share caches, but not costs.
+        dear = cv.clone()
+        dear.rock_push_cost = 20
+        self.assertEqual(dear.find_path(goal)[0], 23)
+        self.assertEqual(dear.distances_from([goal])[goal][0], 23)
+        self.assertEqual(cv.distances_from([goal])[goal][0], cave.ROCK_PUSH_COST + 3)
+
+    def test_find_path_other_start(self):
+        cv = cave.Cave()
+        with open('../maps/horock2.map') as f:
+            cv.load_file(f)
+        # Moving onto the robot costs nothing, which the A* heuristic allows
+        # for when the path starts elsewhere.
+        start = (2, 3)
+        for goal in cv.find_squares([cave.CAVE_LAMBDA, cave.CAVE_CLOSED_LIFT]):
+            paths = cv.distances_from([goal], start)
+            if goal in paths:
+                self.assertEqual(cv.find_path(goal, start)[0], paths[goal][0])
+        self.assertEqual(cv.find_path((1, 1), start), (2.0, ((2, 3), (2, 2), (2, 1), (1, 1))))
+
+    def test_find_path_trampoline(self):
+        cv = self.trampoline_cave
+        moves = dict((cave.DPOS[m], m) for m in cave.PATH_MOVES)
+        for goal in cv.find_squares([cave.CAVE_LAMBDA]):
+            f, path = cv.find_path(goal)
+            self.assertTrue(path)
+            ref_f, ref_path = cv.find_path_reference(goal)
+            if ref_path:
+                self.assertTrue(f <= ref_f)
+            # The path lists the trampolines jumped from, so following it
+            # one square at a time from where the robot is gets to the goal.
+            c = cv
+            for x, y in path[1:]:
+                rx, ry = c._robot_pos
+                c = c.move(moves[(x - rx, y - ry)])
+            self.assertEqual(c._robot_pos, goal)
+        # Jumping is the only way to reach the lambdas behind the trampoline.
+        self.assertTrue(any(not cv.find_path_reference(goal)[1]
+                            for goal in cv.find_squares([cave.CAVE_LAMBDA])))
+
+    def test_path_cache(self):
+        cv = self.cave
+        paths = cv.path_cache
+        goal = cv.find_squares([cave.CAVE_LAMBDA])[0]
+        result = cv.find_path(goal)
+        misses = paths.misses
+        self.assertEqual(cv.clone().find_path(goal), result)
+        self.assertEqual(paths.misses, misses)
+        self.assertEqual(paths.hits, 1)
+        # A changed grid is a different key.
+        next = cv.move(cave.MOVE_DOWN)
+        self.assertTrue(next.path_cache is paths)
+        next.find_path(goal)
+        self.assertEqual(paths.misses, misses + 1)
+        # The least recently used result is dropped first.
+        small = cave.PathCache(2)
+        small.put('a', 1)
+        small.put('b', 2)
+        small.get('a')
+        small.put('c', 3)
+        self.assertEqual((small.get('a'), small.get('b'), small.get('c')), (1, None, 3))
+        self.assertEqual((small.hits, small.misses, small.evictions), (3, 1, 1))
+        self.assertEqual(len(small), 2)
+
+    def test_regions(self):
+        cv = self.trampoline_cave
+        for goal in cv.find_squares([cave.CAVE_LAMBDA]):
+            self.assertTrue(cv.reachable(goal))
+        # Without the trampolines, the lambdas in the other room are cut off.
+        c = cv.clone()
+        for x, y in c.find_squares(cave.CAVE_TRAMPOLINE_CHARS):
+            c.set(x, y, cave.CAVE_WALL)
+        unreachable = [goal for goal in c.find_squares([cave.CAVE_LAMBDA]) if not c.reachable(goal)]
+        self.assertTrue(unreachable)
+        for goal in unreachable:
+            self.assertEqual(c.find_path(goal), (0, ()))
+        # Beards only let the robot through when it carries razors.
+        c = self.cave.clone()
+        x, y = goal = c.find_squares([cave.CAVE_LAMBDA])[0]
+        for nx, ny in cave.neighbour_squares(x, y):
+            if c.at(nx, ny) != cave.CAVE_WALL:
+                c.set(nx, ny, cave.CAVE_BEARD)
+        self.assertFalse(c.reachable(goal))
+        c.razors_carried = 1
+        self.assertTrue(c.reachable(goal))
+        # On the way to a beard, find_path passes through other beards.
+        c.razors_carried = 0
+        c.set(x, y, cave.CAVE_BEARD)
+        self.assertTrue(c.find_path(goal)[1])
+        self.assertTrue(c.reachable(goal))
+        # The closed lift can't be entered, but it is next to the region.
+        self.assertTrue(self.cave.reachable(self.cave._lift_pos))
+
+    def test_path_hierarchy(self):
+        cluster_size = cave.CLUSTER_SIZE
+        cave.CLUSTER_SIZE = 4
+        try:
+            for cv in [self.cave, self.cave.move(cave.MOVE_DOWN), self.trampoline_cave]:
+                portals = dict((cv._pos(i), cv._pos(j)) for i, j in cv._portals().iteritems())
+                for goal in cv.find_squares([cave.CAVE_LAMBDA]):
+                    f, path = cv.find_path(goal, hierarchical=True)
+                    self.assertTrue(f >= cv.find_path(goal)[0])
+                    self.assertEqual(path[0], cv._robot_pos)
+                    # Each step is a move from where the robot is after the
+                    # previous one, which may have been a jump.
+                    x, y = path[0]
+                    for nx, ny in path[1:]:
+                        self.assertEqual(abs(nx - x) + abs(ny - y), 1)
+                        x, y = portals.get((nx, ny), (nx, ny))
+                    self.assertEqual((x, y), goal)
+        finally:
+            cave.CLUSTER_SIZE = cluster_size
+
+    def test_find_safe_path(self):
+        moves = dict((cave.DPOS[m], m) for m in cave.PATH_MOVES + (cave.MOVE_WAIT,))
+        for cv in [self.cave, self.water_cave, self.beard_cave]:
+            for goal in cv.find_squares([cave.CAVE_LAMBDA]):
+                f, path = cv.find_safe_path(goal)
+                if not path:
+                    continue
+                self.assertEqual(path[0], cv._robot_pos)
+                # Shaving takes a move that isn't listed in the path.
+                self.assertTrue(f >= len(path) - 1)
+                # Following the path move by move gets there in one piece.
+                c = cv
+                for x, y in path[1:]:
+                    rx, ry = c._robot_pos
+                    c = c.move(moves[(x - rx, y - ry)])
+                    self.assertNotEqual(c.end_state, cave.END_STATE_LOSE)
+                self.assertEqual(c._robot_pos, goal)
+        goal = min(self.cave.find_squares([cave.CAVE_LAMBDA]),
+                   key=lambda lmb: self.cave.find_path(lmb)[0])
+        self.assertTrue(self.cave.find_safe_path(goal)[1])
+        self.assertEqual(self.cave.find_safe_path(goal, horizon=1), (0, ()))
+
+    def test_path_move(self):
+        self.assertEqual(cave.path_move((3, 3), (3, 4)), cave.MOVE_UP)
+        self.assertEqual(cave.path_move((3, 3), (3, 2)), cave.MOVE_DOWN)
+        self.assertEqual(cave.path_move((3, 3), (2, 3)), cave.MOVE_LEFT)
+        self.assertEqual(cave.path_move((3, 3), (4, 3)), cave.MOVE_RIGHT)
+        self.assertEqual(cave.path_move((3, 3), (3, 3)), cave.MOVE_WAIT)
+        # A safe path that waits for a rock to fall is walked with the wait.
+        cv = cave.Cave()
+        with open('../maps/contest2.map') as f:
+            cv.load_file(f)
+        cv = apply_moves(cv, 'RRUDRRULUUR')
+        goal = (3, 4)
+        f, path = cv.find_safe_path(goal)
+        self.assertEqual(path[0], path[1])
+        moves = optimize.path_moves(cv, path)
+        self.assertEqual(moves[0], cave.MOVE_WAIT)
+        self.assertEqual(len(moves), len(path) - 1)
+        self.assertEqual(apply_moves(cv, moves)._robot_pos, goal)
+        walked, route = solver.BeamSolver(False).walk(cv, '', [solver.Target(goal, cave.CAVE_LAMBDA, path)])
+        self.assertEqual(route, moves)
+        self.assertEqual(walked._robot_pos, goal)
+
+    def test_distances_from(self):
+        for cv in [self.cave, self.beard_cave, self.trampoline_cave]:
+            targets = cv.find_squares([cave.CAVE_LAMBDA, cave.CAVE_ROCK, cave.CAVE_CLOSED_LIFT])
+            paths = cv.distances_from(targets)
+            for target in targets:
+                f, path = cv.find_path(target)
+                if path:
+                    self.assertEqual(paths[target][0], f)
+                    self.assertEqual(paths[target][1][-1], target)
+                else:
+                    self.assertFalse(target in paths)
+
+    def test_distance_matrix(self):
+        lambdas = sorted(self.cave.lambdas)
+        paths = self.cave.distances_from(lambdas)
+        matrix = self.cave.distance_matrix()
+        self.assertEqual(len(matrix.paths), len(lambdas))
+        # Caves with the same move cost layout share the matrix.
+        self.assertTrue(self.cave.clone().distance_matrix() is matrix)
+        self.assertTrue(self.cave.move(cave.MOVE_WAIT).distance_matrix() is matrix)
+        self.assertEqual(self.cave.move(cave.MOVE_WAIT).distances_from(lambdas), paths)
+        # A robot step leaves rocks, beards and water alone, so the matrix is
+        # reused. Only the paths near the squares that changed are dropped.
+        source = (12, 11)
+        near = self.cave.distances_from([(11, 11)], source)
+        stepped = self.cave.move(D)
+        self.assertTrue(stepped.distance_matrix() is matrix)
+        self.assertEqual(matrix.paths[source, (11, 11)], near[(11, 11)])
+        self.assertFalse((self.cave._robot_pos, lambdas[0]) in matrix.paths)
+        fresh = cave.Cave()
+        with open('../maps/task_desc.map') as f:
+            fresh.load_file(f)
+        self.assertEqual(stepped.distances_from(lambdas), fresh.move(D).distances_from(lambdas))
+        # A square that becomes the robot costs nothing to move onto, so the
+        # paths a detour over it might beat are searched for again.
+        source = (11, 3)
+        c = self.cave
+        for move in 'RDRD':
+            c.distances_from(lambdas, source)
+            c = c.move(move)
+        self.assertEqual(c.distances_from(lambdas, source),
+                         apply_moves(fresh, 'RDRD').distances_from(lambdas, source))
+        # A rock gives another configuration, until it is gone again.
+        rocky = stepped.clone()
+        rocky.set(8, 12, cave.CAVE_ROCK)
+        self.assertTrue(rocky.distance_matrix() is not matrix)
+        rocky.set(8, 12, cave.CAVE_EMPTY)
+        self.assertTrue(rocky.distance_matrix() is matrix)
+        # Water changes move costs.
+        flooded = apply_moves(self.water_cave, cave.MOVE_WAIT * self.water_cave.flood_rate)
+        self.assertTrue(flooded.water_level > self.water_cave.water_level)
+        self.assertTrue(flooded.distance_matrix() is not self.water_cave.distance_matrix())
+
+    def test_path_planner(self):
+        cv = self.cave
+        goal = (13, 0)
+        planner = cave.PathPlanner(goal)
+        for move in ROUTE[:30]:
+            f, path = planner.find_path(cv)
+            self.assertEqual(path[0], cv._robot_pos)
+            self.assertEqual(path[-1], goal)
+            self.assertEqual(f, cv.find_path(goal)[0])
+            search = planner._g
+            cv = cv.move(move)
+            planner.find_path(cv)
+            # The search is repaired, not started over.
+            self.assertTrue(planner._g is search)
+        self.assertEqual(cave.PathPlanner((0, 0)).find_path(cv), (0, tuple()))
+
+    def test_priority_queue(self):
+        pq = astar.PriorityQueue()
+        for prio, v in [(3, 'a'), (1, 'b'), (2, 'c'), (2, 'd')]:
+            pq.push(prio, v)
+        self.assertTrue('a' in pq)
+        self.assertFalse('e' in pq)
+        pq.decrease_key(0, 'a')
+        pq.decrease_key(5, 'c')
+        self.assertEqual(len(pq), 4)
+        self.assertEqual([pq.pop() for i in range(4)], [(0, 'a'), (1, 'b'), (2, 'c'), (2, 'd')])
+        self.assertFalse('a' in pq)
+        self.assertEqual(len(pq), 0)
+
     def test_unmovable_rocks(self):
         unmovable = self.unmovable_rock_cave.find_unmovable_rocks()
         self.assertEqual(len(unmovable), 3)
         self.assertTrue((7, 1) in unmovable)
         self.assertTrue((8, 1) in unmovable)
         self.assertTrue((13, 6) in unmovable)
-                
+
+    def test_settled_rocks(self):
+        cv = self.unmovable_rock_cave
+        settled = cv.settled_rocks()
+        self.assertEqual(settled.resting[7, 5], (7, 2))
+        self.assertEqual(settled.resting[7, 4], (6, 1))
+        self.assertEqual(settled.rock_at(7, 2), (7, 5))
+        self.assertEqual(settled.rock_at(7, 5), None)
+        self.assertEqual(settled.unmovable, cv.find_unmovable_rocks())
+        # Moves that don't change the rocks share the analysis.
+        self.assertTrue(cv.move(cave.MOVE_WAIT).settled_rocks() is settled)
+
+    def test_without_rocks(self):
+        rockless = self.cave.without_rocks()
+        self.assertEqual(rockless.find_squares(cave.CAVE_ANY_ROCK), [])
+        # The cave itself is left untouched.
+        self.assertEqual(str(self.cave), self.cave_str)
+        # An earlier copy is updated in place to match a new one.
+        cv = self.cave
+        for move in ROUTE[:30]:
+            cv = cv.move(move)
+            updated = cv.without_rocks(rockless)
+            self.assertTrue(updated is rockless)
+            fresh = cv.without_rocks()
+            self.assertEqual(updated, fresh)
+            self.assertEqual(updated._robot_pos, fresh._robot_pos)
+            self.assertEqual(updated.find_path(cv._lift_pos), fresh.find_path(cv._lift_pos))
+
 if __name__ == '__main__':
     #unittest.main()
     suite = unittest.TestLoader().loadTestsFromTestCase(TestCave)